@@ -1,6 +1,8 @@
 import sys
-import asyncio, json, os, uuid, mimetypes, pathlib, time, signal
+import asyncio, json, os, uuid, mimetypes, pathlib, time, signal, re, hashlib, sqlite3, math, heapq
+from collections import OrderedDict, deque
 import websockets
+from concurrent.futures import ThreadPoolExecutor
 from aiohttp import web
 
 # Determine base directory for static assets
@@ -22,7 +24,8 @@ OUTPUT_DIR = pathlib.Path(os.getenv('OUTPUT_DIR', str(DEFAULT_PROJECTS)))
 OUTPUT_DIR.mkdir(parents=True, exist_ok=True)
 
 # ─── Provision AI guidance docs into WORK_DIR/.gemmit ────────────
-import sys, shutil
+import sys, shutil, tempfile, codecs, weakref, base64, stat, struct, errno, ctypes, ctypes.util, threading
+import gzip, html, email.utils, urllib.parse, socket
 
 
 def _proc_group_kwargs():
@@ -33,10 +36,11 @@ def _proc_group_kwargs():
         return {'creationflags': 0x00000200}
     return {}
 
-def provision_guidance_docs():
-    """Provision AI guidance documents to the .gemmit directory and .geminiignore to WORK_DIR with proper error handling."""
+def provision_guidance_docs(work_dir: pathlib.Path | None = None):
+    """Provision AI guidance documents to the .gemmit directory and .geminiignore to work_dir (default WORK_DIR) with proper error handling."""
+    work_dir = work_dir or WORK_DIR
     try:
-        config_dir = WORK_DIR / ".gemmit"
+        config_dir = work_dir / ".gemmit"
         config_dir.mkdir(parents=True, exist_ok=True)
         
         # Check if we have write permissions to the config directory
@@ -88,7 +92,7 @@ def provision_guidance_docs():
 
     # Copy .geminiignore directly to WORK_DIR (Gemmit_Projects folder)
     geminiignore_src = BASE_DIR / ".geminiignore"
-    geminiignore_dest = WORK_DIR / ".geminiignore"
+    geminiignore_dest = work_dir / ".geminiignore"
     
     if geminiignore_src.exists():
         should_copy_ignore = False
@@ -111,9 +115,9 @@ def provision_guidance_docs():
                     shutil.copy2(geminiignore_src, geminiignore_dest)
                 except (OSError, PermissionError):
                     shutil.copy(geminiignore_src, geminiignore_dest)
-                print(f"Copied .geminiignore to {WORK_DIR}")
+                print(f"Copied .geminiignore to {work_dir}")
             except Exception as e:
-                print(f"Warning: could not copy .geminiignore to {WORK_DIR}: {e}", file=sys.stderr)
+                print(f"Warning: could not copy .geminiignore to {work_dir}: {e}", file=sys.stderr)
     else:
         print(f"Warning: .geminiignore source file not found at {geminiignore_src}", file=sys.stderr)
 
@@ -774,26 +778,28 @@ def _ensure_geminiignore_in(dir_path: pathlib.Path) -> bool:
         return False
 
 
-def _repoint_conversation_store(new_work_dir: pathlib.Path):
+def _repoint_conversation_store(store):
     """
-    Update globals that depend on WORK_DIR and reload conversations for the new location.
+    Swap in the conversation store of the new WORK_DIR (on the event loop, which owns
+    the globals) and drop state that belonged to the old one.
     """
-    global CONVERSATIONS_FILE, conversations
-    CONVERSATIONS_FILE = new_work_dir / '.gemmit' / 'conversations.json'
-    conversations = load_conversations()
+    global conversations
+    old_store = conversations
+    conversations = store
+    _history_windows.clear()
+    # Close behind any writes still queued for the old workspace
+    _conversation_store_executor.submit(old_store.close)
 
 
-def change_work_dir_sync(path_str: str, *, relative_to_current: bool = False, also_update_output_dir: bool = False):
+def _prepare_work_dir_sync(target: pathlib.Path):
     """
-    Synchronous helper to switch WORK_DIR.
+    Blocking half of a WORK_DIR switch, run on _conversation_store_executor.
     - Creates the directory (and .gemmit) if missing.
-    - Auto-provisions .geminiignore if absent.
-    - Repoints conversations store.
-    Returns dict with details for the UI.
+    - Auto-provisions .geminiignore and the guidance docs.
+    - Opens its conversation store, which can import legacy files, backfill the
+      search index or migrate, and must come after writes queued for the old one.
+    Returns (store, created, copied_ignore).
     """
-    global WORK_DIR, OUTPUT_DIR
-
-    target = _resolve_target_dir(path_str, relative_to_current=relative_to_current)
     created = False
     if not target.exists():
         target.mkdir(parents=True, exist_ok=True)
@@ -805,6 +811,26 @@ def change_work_dir_sync(path_str: str, *, relative_to_current: bool = False, al
     # If the target doesn't have a .geminiignore, copy it in
     copied_ignore = _ensure_geminiignore_in(target)
 
+    # Provision guidance docs, ignore errors
+    try:
+        provision_guidance_docs(target)
+    except Exception as e:
+        print(f"Warning: provision_guidance_docs() after dir change: {e}", file=sys.stderr)
+
+    return open_conversation_store(target), created, copied_ignore
+
+
+async def change_work_dir(path_str: str, *, relative_to_current: bool = False, also_update_output_dir: bool = False):
+    """
+    Switch WORK_DIR. The slow part runs off the event loop; WORK_DIR, OUTPUT_DIR
+    and the conversation store are then swapped together on it.
+    Returns dict with details for the UI.
+    """
+    global WORK_DIR, OUTPUT_DIR
+
+    target = _resolve_target_dir(path_str, relative_to_current=relative_to_current)
+    store, created, copied_ignore = await store_call(_prepare_work_dir_sync, target)
+
     # Switch the active work dir
     WORK_DIR = target
 
@@ -812,14 +838,8 @@ def change_work_dir_sync(path_str: str, *, relative_to_current: bool = False, al
     if also_update_output_dir:
         OUTPUT_DIR = target
 
-    # Provision guidance docs (uses WORK_DIR), ignore errors
-    try:
-        provision_guidance_docs()
-    except Exception as e:
-        print(f"Warning: provision_guidance_docs() after dir change: {e}", file=sys.stderr)
-
     # Repoint conversation store for the new directory
-    _repoint_conversation_store(WORK_DIR)
+    _repoint_conversation_store(store)
 
     return {
         "workDir": str(WORK_DIR),
@@ -829,41 +849,714 @@ def change_work_dir_sync(path_str: str, *, relative_to_current: bool = False, al
 
 
 GEMINI_BIN = os.getenv('GEMINI_PATH', 'gemini')
+GEMINI_MODEL = os.getenv('GEMINI_MODEL', 'gemini-2.5-flash')
+# How the prompt reaches gemini:
+#   stdin - piped into the process (default; no argv size limit, not visible in ps)
+#   file  - written to a memory-backed temp file that becomes the process's stdin
+#   argv  - passed as `-p <prompt>` (legacy; fails with E2BIG on long histories)
+GEMINI_PROMPT_MODE = os.getenv('GEMINI_PROMPT_MODE', 'stdin').lower()
 PORT = int(os.getenv('PORT', 8000))
 HOST = os.getenv('HOST', '127.0.0.1')
 HOST = os.getenv('HOST', '127.0.0.1')
 
 # Persistent conversation storage
-CONVERSATIONS_FILE = WORK_DIR / '.gemmit' / 'conversations.json'
+# Each conversation lives in its own append-only shard under .gemmit/conversations/,
+# next to a small index (preview, message count, timestamps) that is all we read
+# up front. Index updates are appended to index.log and compacted into index.json
+# once enough records have accumulated.
+CONVERSATIONS_COMPACT_EVERY = int(os.getenv('CONVERSATIONS_COMPACT_EVERY', 200))
+CONVERSATION_CACHE_SIZE = int(os.getenv('CONVERSATION_CACHE_SIZE', 32))
 
-def load_conversations():
-    """Load conversations from persistent storage."""
-    if CONVERSATIONS_FILE.exists():
-        try:
-            with open(CONVERSATIONS_FILE, 'r', encoding='utf-8') as f:
-                return json.load(f)
-        except (json.JSONDecodeError, PermissionError, OSError) as e:
-            print(f"Warning: Could not load conversations: {e}", file=sys.stderr)
-    return {}
+# Single worker: every store operation runs here, in submission order, off the event loop
+_conversation_store_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='conversation-store')
 
-def save_conversations(conversations):
-    """Save conversations to persistent storage."""
+def _read_log_records(log_file: pathlib.Path):
+    """
+    Return the JSON records of an append-only log file.
+    A torn trailing record (crash mid-append) is dropped and truncated away
+    so the next append starts on a clean line.
+    """
+    records = []
+    if not log_file.exists():
+        return records
     try:
-        CONVERSATIONS_FILE.parent.mkdir(parents=True, exist_ok=True)
-        with open(CONVERSATIONS_FILE, 'w', encoding='utf-8') as f:
-            json.dump(conversations, f, indent=2, ensure_ascii=False)
+        good_offset = 0
+        with open(log_file, 'rb') as f:
+            for line in f:
+                if not line.endswith(b'\n'):
+                    break
+                try:
+                    records.append(json.loads(line))
+                except json.JSONDecodeError as e:
+                    print(f"Warning: Skipping bad record in {log_file.name}: {e}", file=sys.stderr)
+                good_offset += len(line)
+        if good_offset < log_file.stat().st_size:
+            print(f"Warning: Truncating partial record at end of {log_file}", file=sys.stderr)
+            with open(log_file, 'r+b') as f:
+                f.truncate(good_offset)
     except (PermissionError, OSError) as e:
-        print(f"Warning: Could not save conversations: {e}", file=sys.stderr)
+        print(f"Warning: Could not read {log_file}: {e}", file=sys.stderr)
+    return records
+
+def _apply_log_record(turns: list, record: dict) -> bool:
+    """
+    Apply one append record ({"at", "turns"}) to a conversation's turn list.
+    "at" is the index of the first appended turn, which makes replay idempotent:
+    turns that are already present are skipped.
+    """
+    at = int(record.get('at', len(turns)))
+    if at > len(turns):
+        print(f"Warning: gap in conversation log (at={at}, have={len(turns)})", file=sys.stderr)
+        return False
+    turns.extend(record['turns'][len(turns) - at:])
+    return True
+
+def _append_log_record(log_file: pathlib.Path, record: dict):
+    """Append one record to a log file and fsync it."""
+    log_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(log_file, 'a', encoding='utf-8') as f:
+        f.write(json.dumps(record, ensure_ascii=False) + '\n')
+        f.flush()
+        os.fsync(f.fileno())
+
+def _write_snapshot(snapshot_file: pathlib.Path, log_file: pathlib.Path, snapshot):
+    """Atomically replace a snapshot file, then truncate the log it now covers."""
+    tmp = snapshot_file.with_suffix(snapshot_file.suffix + '.tmp')
+    snapshot_file.parent.mkdir(parents=True, exist_ok=True)
+    with open(tmp, 'w', encoding='utf-8') as f:
+        json.dump(snapshot, f, ensure_ascii=False)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, snapshot_file)
+    # A crash before this point only means the log gets replayed on top of the snapshot
+    with open(log_file, 'w', encoding='utf-8'):
+        pass
+
+def _conversation_preview(first_message: str) -> str:
+    preview = first_message.replace("User: ", "").strip()[:100]
+    if len(preview) > 100:
+        preview += "..."
+    return preview
+
+def _search_tokens(text: str) -> list[str]:
+    return re.findall(r'\w+', text.lower())
+
+def _strip_role(turn: str) -> tuple[str, str]:
+    """Split a stored "User: ..."/"Model: ..." turn into (role, text)."""
+    for role in ('User', 'Model'):
+        if turn.startswith(role + ': '):
+            return role.lower(), turn[len(role) + 2:]
+    return '', turn
+
+def _make_snippet(text: str, terms, width: int = 80) -> str:
+    """A window of text around the first occurrence of any query term."""
+    lowered = text.lower()
+    positions = [p for p in (lowered.find(t) for t in terms) if p >= 0]
+    start = max(0, min(positions) - width // 2) if positions else 0
+    snippet = ' '.join(text[start:start + width * 2].split())
+    if start > 0:
+        snippet = '…' + snippet
+    if start + width * 2 < len(text):
+        snippet += '…'
+    return snippet
+
+
+class ConversationSearchIndex:
+    """
+    In-memory inverted index over conversation turns, ranked with BM25.
+    Documents are (conversation_id, turn_index) pairs; queries match turns
+    containing every query term.
+    """
+
+    K1 = 1.2
+    B = 0.75
+
+    def __init__(self):
+        self.postings: dict[str, dict[tuple[str, int], int]] = {}
+        self.doc_lengths: dict[tuple[str, int], int] = {}
+        self.total_length = 0
+
+    def add(self, conversation_id: str, index: int, turn: str):
+        tokens = _search_tokens(_strip_role(turn)[1])
+        key = (conversation_id, index)
+        counts: dict[str, int] = {}
+        for token in tokens:
+            counts[token] = counts.get(token, 0) + 1
+        for token, count in counts.items():
+            self.postings.setdefault(token, {})[key] = count
+        self.doc_lengths[key] = len(tokens)
+        self.total_length += len(tokens)
+
+    def search(self, query: str, limit: int = 20) -> list[tuple[float, str, int]]:
+        """Return up to limit (score, conversation_id, turn_index) hits, best first."""
+        terms = set(_search_tokens(query))
+        if not terms or not self.doc_lengths:
+            return []
+        lists = sorted((self.postings.get(t, {}) for t in terms), key=len)
+        if not lists[0]:
+            return []
+        candidates = set(lists[0]).intersection(*lists[1:])
+        n = len(self.doc_lengths)
+        avg_length = self.total_length / n
+        idf = {t: math.log(1 + (n - len(self.postings[t]) + 0.5) / (len(self.postings[t]) + 0.5)) for t in terms}
+        scored = []
+        for key in candidates:
+            norm = self.K1 * (1 - self.B + self.B * self.doc_lengths[key] / avg_length)
+            score = 0.0
+            for t in terms:
+                tf = self.postings[t][key]
+                score += idf[t] * tf * (self.K1 + 1) / (tf + norm)
+            scored.append((score, key[0], key[1]))
+        return heapq.nlargest(limit, scored)
+
+
+class ConversationStore:
+    """
+    Sharded, lazily loaded conversation storage for one workspace.
+
+    Layout under <work_dir>/.gemmit/conversations/:
+      <shard>.jsonl        append-only {"at", "turns"} records for one conversation
+      index.json/index.log id -> {preview, messageCount, created, updated}
+
+    Methods block on disk I/O; call them through store_call() from async code.
+    """
+
+    def __init__(self, work_dir: pathlib.Path, cache_size: int = CONVERSATION_CACHE_SIZE):
+        self.config_dir = work_dir / '.gemmit'
+        self.root = self.config_dir / 'conversations'
+        self.index_file = self.root / 'index.json'
+        self.index_log_file = self.root / 'index.log'
+        self.cache_size = max(1, cache_size)
+        self.index: dict[str, dict] = {}
+        self._cache: OrderedDict[str, list[str]] = OrderedDict()
+        self._index_records = 0
+        self._search_index: ConversationSearchIndex | None = None  # built on first search
+        self._load_index()
+        self._migrate_legacy()
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, conversation_id):
+        return conversation_id in self.index
+
+    def _shard_path(self, conversation_id: str) -> pathlib.Path:
+        # Client-supplied ids are normally UUIDs; hash anything that isn't filename-safe
+        if re.fullmatch(r'[A-Za-z0-9_-]{1,128}', conversation_id):
+            name = conversation_id
+        else:
+            name = hashlib.sha1(conversation_id.encode('utf-8')).hexdigest()
+        return self.root / f"{name}.jsonl"
+
+    def _load_index(self):
+        if self.index_file.exists():
+            try:
+                with open(self.index_file, 'r', encoding='utf-8') as f:
+                    self.index = json.load(f)
+            except (json.JSONDecodeError, PermissionError, OSError) as e:
+                print(f"Warning: Could not load conversation index: {e}", file=sys.stderr)
+        records = _read_log_records(self.index_log_file)
+        for entry in records:
+            if 'id' in entry:
+                self.index[entry['id']] = entry
+        self._index_records = len(records)
+
+    def _migrate_legacy(self):
+        """One-time import of the old single-file conversations.json (+ conversations.log)."""
+        legacy_file = self.config_dir / 'conversations.json'
+        legacy_log = self.config_dir / 'conversations.log'
+        if self.index or not (legacy_file.exists() or legacy_log.exists()):
+            return
+        legacy = {}
+        try:
+            if legacy_file.exists():
+                with open(legacy_file, 'r', encoding='utf-8') as f:
+                    legacy = json.load(f)
+            for record in _read_log_records(legacy_log):
+                _apply_log_record(legacy.setdefault(record['id'], []), record)
+            stamp = max((p.stat().st_mtime for p in (legacy_file, legacy_log) if p.exists()), default=time.time())
+            for cid, turns in legacy.items():
+                if turns:
+                    self._write_turns(cid, 0, turns, created=stamp, updated=stamp)
+            self._compact_index()
+            for p in (legacy_file, legacy_log):
+                if p.exists():
+                    os.replace(p, p.with_name(p.name + '.migrated'))
+            print(f"Migrated {len(legacy)} conversations to {self.root}", file=sys.stderr)
+        except (json.JSONDecodeError, KeyError, PermissionError, OSError) as e:
+            print(f"Warning: Could not migrate legacy conversations: {e}", file=sys.stderr)
+
+    def _remember(self, conversation_id: str, turns: list[str]):
+        self._cache[conversation_id] = turns
+        self._cache.move_to_end(conversation_id)
+        while len(self._cache) > self.cache_size:
+            self._cache.popitem(last=False)
+
+    def get(self, conversation_id: str) -> list[str] | None:
+        """Return the turns of a conversation, reading its shard on a cache miss."""
+        if conversation_id in self._cache:
+            self._cache.move_to_end(conversation_id)
+            return self._cache[conversation_id]
+        if conversation_id not in self.index:
+            return None
+        turns: list[str] = []
+        for record in _read_log_records(self._shard_path(conversation_id)):
+            _apply_log_record(turns, record)
+        self._remember(conversation_id, turns)
+        return turns
+
+    def _write_turns(self, conversation_id: str, at: int, turns: list[str], *, created=None, updated=None):
+        _append_log_record(self._shard_path(conversation_id), {'id': conversation_id, 'at': at, 'turns': turns})
+        now = time.time()
+        entry = self.index.get(conversation_id) or {
+            'id': conversation_id,
+            'preview': _conversation_preview(turns[0] if turns else ""),
+            'created': created or now,
+        }
+        entry = {**entry, 'messageCount': at + len(turns), 'updated': updated or now}
+        self.index[conversation_id] = entry
+        _append_log_record(self.index_log_file, entry)
+        self._index_records += 1
 
-# Load conversations on startup
-conversations: dict[str, list[str]] = load_conversations()
+    def append(self, conversation_id: str, turns: list[str]) -> int:
+        """Append turns to a conversation; returns the new message count."""
+        history = self.get(conversation_id)
+        if history is None:
+            history = []
+            self._remember(conversation_id, history)
+        try:
+            self._write_turns(conversation_id, len(history), turns)
+        except (PermissionError, OSError) as e:
+            print(f"Warning: Could not save conversation {conversation_id}: {e}", file=sys.stderr)
+        if self._search_index is not None:
+            for i, turn in enumerate(turns, start=len(history)):
+                self._search_index.add(conversation_id, i, turn)
+        history.extend(turns)
+        if self._index_records >= CONVERSATIONS_COMPACT_EVERY:
+            self._compact_index()
+        return len(history)
+
+    def _compact_index(self):
+        try:
+            _write_snapshot(self.index_file, self.index_log_file, self.index)
+            self._index_records = 0
+        except (PermissionError, OSError) as e:
+            print(f"Warning: Could not compact conversation index: {e}", file=sys.stderr)
+
+    def list_entries(self, offset: int = 0, limit: int | None = None) -> tuple[list[dict], int]:
+        """A page of index entries for non-empty conversations (most recently updated first) and the total."""
+        entries = [e for e in self.index.values() if e.get('messageCount')]
+        entries.sort(key=lambda e: e.get('updated', 0), reverse=True)
+        end = None if limit is None else offset + limit
+        return entries[offset:end], len(entries)
+
+    def search(self, query: str, limit: int = 20) -> list[dict]:
+        """Ranked turn hits for query; the inverted index is built once, then kept up to date by append()."""
+        if self._search_index is None:
+            started = time.time()
+            search_index = ConversationSearchIndex()
+            for cid in list(self.index):
+                turns: list[str] = []
+                for record in _read_log_records(self._shard_path(cid)):
+                    _apply_log_record(turns, record)
+                for i, turn in enumerate(turns):
+                    search_index.add(cid, i, turn)
+            self._search_index = search_index
+            print(f"Built conversation search index over {len(search_index.doc_lengths)} turns "
+                  f"in {time.time() - started:.2f}s", file=sys.stderr)
+        terms = _search_tokens(query)
+        hits = []
+        for score, cid, idx in self._search_index.search(query, limit):
+            turns = self.get(cid) or []
+            if idx >= len(turns):
+                continue
+            role, text = _strip_role(turns[idx])
+            hits.append({
+                'conversationId': cid,
+                'turnIndex': idx,
+                'role': role,
+                'score': round(score, 4),
+                'snippet': _make_snippet(text, terms),
+                'preview': self.index.get(cid, {}).get('preview', ''),
+            })
+        return hits
+
+    def close(self):
+        pass
+
+
+class SQLiteConversationStore:
+    """
+    SQLite-backed conversation storage for one workspace (.gemmit/conversations.db).
+
+    Turns are keyed by (conversation_id, idx) and conversations carry real
+    created/updated timestamps with an index on updated, so listing is an
+    ordered, paginated index scan. The database runs in WAL mode; like
+    ConversationStore, methods block and must go through store_call().
+    """
+
+    def __init__(self, work_dir: pathlib.Path):
+        self.config_dir = work_dir / '.gemmit'
+        self.config_dir.mkdir(parents=True, exist_ok=True)
+        self.db_file = self.config_dir / 'conversations.db'
+        # Opened here, used only from the store executor thread afterwards
+        self.db = sqlite3.connect(str(self.db_file), check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.executescript("""
+            CREATE TABLE IF NOT EXISTS conversations (
+                id TEXT PRIMARY KEY,
+                preview TEXT NOT NULL DEFAULT '',
+                message_count INTEGER NOT NULL DEFAULT 0,
+                created REAL NOT NULL,
+                updated REAL NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS conversations_by_updated ON conversations(updated DESC);
+            CREATE TABLE IF NOT EXISTS turns (
+                conversation_id TEXT NOT NULL,
+                idx INTEGER NOT NULL,
+                content TEXT NOT NULL,
+                created REAL NOT NULL,
+                PRIMARY KEY (conversation_id, idx)
+            ) WITHOUT ROWID;
+        """)
+        self._count = self.db.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+        if self._count == 0:
+            self._import_file_store(work_dir)
+        self.fts = self._setup_fts()
+
+    def _setup_fts(self) -> bool:
+        """Create the FTS5 index over turns (backfilling older databases); False if FTS5 is unavailable."""
+        try:
+            self.db.execute(
+                "CREATE VIRTUAL TABLE IF NOT EXISTS turns_fts USING fts5("
+                "content, conversation_id UNINDEXED, idx UNINDEXED, tokenize='unicode61')")
+            indexed = self.db.execute("SELECT COUNT(*) FROM turns_fts").fetchone()[0]
+            total = self.db.execute("SELECT COUNT(*) FROM turns").fetchone()[0]
+            if indexed != total:
+                with self.db:
+                    self.db.execute("DELETE FROM turns_fts")
+                    self.db.execute(
+                        "INSERT INTO turns_fts (content, conversation_id, idx) "
+                        "SELECT content, conversation_id, idx FROM turns")
+                print(f"Indexed {total} turns for full-text search", file=sys.stderr)
+            return True
+        except sqlite3.OperationalError as e:
+            print(f"Warning: SQLite FTS5 unavailable, conversation search disabled: {e}", file=sys.stderr)
+            return False
+
+    def __len__(self):
+        # Cached so the event loop can log it without touching the connection
+        return self._count
+
+    def __contains__(self, conversation_id):
+        return self.db.execute(
+            "SELECT 1 FROM conversations WHERE id = ?", (conversation_id,)).fetchone() is not None
+
+    def _import_file_store(self, work_dir: pathlib.Path):
+        """Seed an empty database from the sharded (or legacy single-file) JSON store."""
+        if not ((self.config_dir / 'conversations').exists()
+                or (self.config_dir / 'conversations.json').exists()
+                or (self.config_dir / 'conversations.log').exists()):
+            return
+        source = ConversationStore(work_dir, cache_size=1)
+        with self.db:
+            for cid, entry in source.index.items():
+                turns = source.get(cid) or []
+                if not turns:
+                    continue
+                created, updated = entry.get('created', time.time()), entry.get('updated', time.time())
+                self.db.execute(
+                    "INSERT OR REPLACE INTO conversations (id, preview, message_count, created, updated) VALUES (?, ?, ?, ?, ?)",
+                    (cid, entry.get('preview', ''), len(turns), created, updated))
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO turns (conversation_id, idx, content, created) VALUES (?, ?, ?, ?)",
+                    [(cid, i, t, updated) for i, t in enumerate(turns)])
+        self._count = self.db.execute("SELECT COUNT(*) FROM conversations").fetchone()[0]
+        print(f"Imported {self._count} conversations into {self.db_file}", file=sys.stderr)
+
+    def get(self, conversation_id: str) -> list[str] | None:
+        rows = self.db.execute(
+            "SELECT content FROM turns WHERE conversation_id = ? ORDER BY idx", (conversation_id,)).fetchall()
+        if not rows and conversation_id not in self:
+            return None
+        return [r[0] for r in rows]
+
+    def append(self, conversation_id: str, turns: list[str]) -> int:
+        now = time.time()
+        try:
+            with self.db:
+                row = self.db.execute(
+                    "SELECT message_count FROM conversations WHERE id = ?", (conversation_id,)).fetchone()
+                at = row[0] if row else 0
+                if row is None:
+                    self.db.execute(
+                        "INSERT INTO conversations (id, preview, message_count, created, updated) VALUES (?, ?, 0, ?, ?)",
+                        (conversation_id, _conversation_preview(turns[0] if turns else ""), now, now))
+                    self._count += 1
+                self.db.executemany(
+                    "INSERT INTO turns (conversation_id, idx, content, created) VALUES (?, ?, ?, ?)",
+                    [(conversation_id, at + i, t, now) for i, t in enumerate(turns)])
+                if self.fts:
+                    self.db.executemany(
+                        "INSERT INTO turns_fts (content, conversation_id, idx) VALUES (?, ?, ?)",
+                        [(t, conversation_id, at + i) for i, t in enumerate(turns)])
+                self.db.execute(
+                    "UPDATE conversations SET message_count = ?, updated = ? WHERE id = ?",
+                    (at + len(turns), now, conversation_id))
+            return at + len(turns)
+        except sqlite3.Error as e:
+            print(f"Warning: Could not save conversation {conversation_id}: {e}", file=sys.stderr)
+            return 0
+
+    def list_entries(self, offset: int = 0, limit: int | None = None) -> tuple[list[dict], int]:
+        total = self.db.execute("SELECT COUNT(*) FROM conversations WHERE message_count > 0").fetchone()[0]
+        rows = self.db.execute(
+            "SELECT id, preview, message_count, created, updated FROM conversations "
+            "WHERE message_count > 0 ORDER BY updated DESC LIMIT ? OFFSET ?",
+            (-1 if limit is None else limit, offset)).fetchall()
+        entries = [{'id': r[0], 'preview': r[1], 'messageCount': r[2], 'created': r[3], 'updated': r[4]} for r in rows]
+        return entries, total
+
+    def search(self, query: str, limit: int = 20) -> list[dict]:
+        terms = _search_tokens(query)
+        if not self.fts or not terms:
+            return []
+        # Quote every term so user input can't inject FTS5 query syntax
+        match = ' '.join('"%s"' % t for t in terms)
+        rows = self.db.execute(
+            "SELECT f.conversation_id, f.idx, bm25(turns_fts), f.content, c.preview "
+            "FROM turns_fts f JOIN conversations c ON c.id = f.conversation_id "
+            "WHERE turns_fts MATCH ? ORDER BY bm25(turns_fts) LIMIT ?",
+            (match, limit)).fetchall()
+        hits = []
+        for cid, idx, rank, content, preview in rows:
+            role, text = _strip_role(content)
+            hits.append({
+                'conversationId': cid,
+                'turnIndex': idx,
+                'role': role,
+                'score': round(-rank, 4),
+                'snippet': _make_snippet(text, terms),
+                'preview': preview,
+            })
+        return hits
+
+    def close(self):
+        self.db.close()
+
+
+# "files" (sharded JSON, default) or "sqlite"
+CONVERSATION_STORE = os.getenv('CONVERSATION_STORE', 'files').lower()
+
+def open_conversation_store(work_dir: pathlib.Path):
+    """Open the configured conversation store for a workspace."""
+    if CONVERSATION_STORE == 'sqlite':
+        try:
+            return SQLiteConversationStore(work_dir)
+        except sqlite3.Error as e:
+            print(f"Warning: Could not open SQLite conversation store, using files: {e}", file=sys.stderr)
+    return ConversationStore(work_dir)
+
+
+async def store_call(fn, *args):
+    """Run a blocking ConversationStore method on the store executor."""
+    return await asyncio.get_running_loop().run_in_executor(_conversation_store_executor, fn, *args)
+
+# Open the store on startup (reads only the index)
+conversations = open_conversation_store(WORK_DIR)
+
+# Prompt history window: only the most recent turns that fit this many characters
+# (roughly 4 characters per token) are sent to gemini; 0 disables the limit.
+HISTORY_MAX_CHARS = int(os.getenv('HISTORY_MAX_CHARS', 48000))
+
+
+class HistoryWindow:
+    """
+    The most recent turns of one conversation that fit in a character budget.
+    Maintained incrementally: new turns are appended to the assembled text and
+    the oldest ones are sliced off, so a new message never re-joins the whole history.
+    """
+
+    MAX_TOPICS = 8
+
+    def __init__(self, budget: int):
+        self.budget = budget
+        self.turn_count = 0
+        self.kept: deque[str] = deque()
+        self.body = ''
+        self.elided = 0
+        self.elided_topics: deque[str] = deque(maxlen=self.MAX_TOPICS)
+
+    def _fit(self, turn: str) -> str:
+        # A single turn larger than the whole budget keeps its head and tail
+        if self.budget <= 0 or len(turn) <= self.budget:
+            return turn
+        half = self.budget // 2
+        return f"{turn[:half]}\n[… {len(turn) - 2 * half} characters omitted …]\n{turn[-half:]}"
+
+    def extend(self, turns: list[str]):
+        for turn in turns:
+            turn = self._fit(turn)
+            self.kept.append(turn)
+            self.body = f"{self.body}\n{turn}" if self.body else turn
+            self.turn_count += 1
+        while self.budget > 0 and len(self.body) > self.budget and len(self.kept) > 1:
+            self._drop_oldest()
+            # Don't leave a model reply whose question was dropped at the head of the window
+            while len(self.kept) > 1 and self.kept[0].startswith('Model: '):
+                self._drop_oldest()
+
+    def _drop_oldest(self):
+        dropped = self.kept.popleft()
+        self.body = self.body[len(dropped) + 1:]
+        self.elided += 1
+        role, text = _strip_role(dropped)
+        if role == 'user':
+            self.elided_topics.append(' '.join(text.split())[:80])
+
+    def render(self) -> str:
+        if not self.elided:
+            return self.body
+        header = f"[{self.elided} earlier messages omitted to fit the context budget"
+        if self.elided_topics:
+            header += "; most recent earlier user requests: " + " | ".join(self.elided_topics)
+        return f"{header}]\n{self.body}"
+
+
+_history_windows: OrderedDict[str, HistoryWindow] = OrderedDict()
+
+def history_window(conversation_id: str, turns: list[str]) -> str:
+    """Assemble the bounded history prefix for a conversation, reusing the cached window."""
+    window = _history_windows.get(conversation_id)
+    if window is None or window.turn_count > len(turns):
+        window = HistoryWindow(HISTORY_MAX_CHARS)
+    window.extend(turns[window.turn_count:])
+    _history_windows[conversation_id] = window
+    _history_windows.move_to_end(conversation_id)
+    while len(_history_windows) > CONVERSATION_CACHE_SIZE:
+        _history_windows.popitem(last=False)
+    return window.render()
 startup_time = time.time()
 print(f"Backend started at {time.ctime(startup_time)}, loaded {len(conversations)} conversations", file=sys.stderr)
 
+# Run scheduling: at most MAX_CONCURRENT_RUNS gemini runs at once. Waiting runs
+# are served round-robin across clients, and a conversation never runs twice at once.
+MAX_CONCURRENT_RUNS = int(os.getenv('MAX_CONCURRENT_RUNS', 4))
+
+
+class _RunTicket:
+    __slots__ = ('client', 'conversation_id', 'future', 'on_position', 'position', 'enqueued')
+
+    def __init__(self, client, conversation_id, future, on_position):
+        self.client = client
+        self.conversation_id = conversation_id
+        self.future = future
+        self.on_position = on_position
+        self.position = None
+        self.enqueued = time.time()
+
+
+class RunScheduler:
+    """Concurrency limiter with a per-client fair queue in front of run_gemini."""
+
+    def __init__(self, max_concurrent: int):
+        self.max_concurrent = max(1, max_concurrent)
+        self.running: dict[str, object] = {}  # conversation id -> client
+        self.queues: OrderedDict[object, deque[_RunTicket]] = OrderedDict()
+        self.started = 0
+        self.waited = 0
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def _queued(self) -> list[_RunTicket]:
+        """Waiting tickets in the order they would be dispatched (round-robin over clients)."""
+        order, depth = [], 0
+        queues = list(self.queues.values())
+        while True:
+            layer = [q[depth] for q in queues if len(q) > depth]
+            if not layer:
+                return order
+            order.extend(layer)
+            depth += 1
+
+    def _next_ticket(self) -> _RunTicket | None:
+        for client, queue in list(self.queues.items()):
+            for ticket in queue:
+                if ticket.conversation_id not in self.running:
+                    queue.remove(ticket)
+                    # This client goes to the back of the rotation
+                    self.queues.move_to_end(client)
+                    if not queue:
+                        del self.queues[client]
+                    return ticket
+        return None
+
+    def _dispatch(self):
+        while len(self.running) < self.max_concurrent:
+            ticket = self._next_ticket()
+            if ticket is None:
+                break
+            if ticket.future.done():
+                continue  # its waiter was cancelled and has not run its cleanup yet
+            self.running[ticket.conversation_id] = ticket.client
+            waited = time.time() - ticket.enqueued
+            self.started += 1
+            if ticket.position is not None:
+                self.waited += 1
+                self.total_wait += waited
+                self.max_wait = max(self.max_wait, waited)
+            ticket.future.set_result(None)
+        for position, ticket in enumerate(self._queued(), start=1):
+            if ticket.position != position:
+                ticket.position = position
+                asyncio.create_task(ticket.on_position(position, self.queue_length))
+
+    @property
+    def queue_length(self) -> int:
+        return sum(len(q) for q in self.queues.values())
+
+    async def acquire(self, client, conversation_id: str, on_position):
+        """Wait for a run slot; on_position(position, queue_length) is awaited whenever the position changes."""
+        ticket = _RunTicket(client, conversation_id, asyncio.get_running_loop().create_future(), on_position)
+        self.queues.setdefault(client, deque()).append(ticket)
+        self._dispatch()
+        try:
+            await ticket.future
+        except asyncio.CancelledError:
+            queue = self.queues.get(client)
+            if queue is not None and ticket in queue:
+                queue.remove(ticket)
+                if not queue:
+                    del self.queues[client]
+                self._dispatch()
+            elif ticket.future.done() and not ticket.future.cancelled():
+                self.release(conversation_id)
+            raise
+
+    def release(self, conversation_id: str):
+        self.running.pop(conversation_id, None)
+        self._dispatch()
+
+    def stats(self) -> dict:
+        return {
+            'maxConcurrent': self.max_concurrent,
+            'running': list(self.running),
+            'queued': [t.conversation_id for t in self._queued()],
+            'clientsWaiting': len(self.queues),
+            'started': self.started,
+            'waited': self.waited,
+            'avgWaitSeconds': round(self.total_wait / self.waited, 3) if self.waited else 0.0,
+            'maxWaitSeconds': round(self.max_wait, 3),
+        }
+
+
+run_scheduler = RunScheduler(MAX_CONCURRENT_RUNS)
+
 # Process tracking for cancellation
 active_processes: dict[str, asyncio.subprocess.Process] = {}
-active_tasks: dict[str, asyncio.Task] = {}  # Track the actual tasks for cancellation
-frontend_processes: dict[int, asyncio.subprocess.Process] = {}
+active_tasks: dict[str, list[asyncio.Task]] = {}  # Track the actual tasks for cancellation (running and queued runs)
+frontend_processes: dict[int, "asyncio.subprocess.Process | PreviewServer"] = {}
 
 # HTTP server: static files and health endpoint
 STATIC_ROOT = BASE_DIR / 'app'
@@ -871,88 +1564,1808 @@ STATIC_ROOT = BASE_DIR / 'app'
 async def health(request):
     return web.Response(text='ok')
 
-@web.middleware
-async def spa_fallback(request, handler):
+# The UI in app/ is read once at startup and served from memory: every file up
+# to STATIC_PRELOAD_MAX_BYTES is kept as is and gzip/brotli-compressed, with a
+# strong (content-hash) ETag per encoding. Files are re-read if they change on
+# disk, checked at most every couple of seconds per file; the check and the
+# rebuild run on the file I/O pool while the current copy keeps being served.
+STATIC_MAX_AGE = int(os.getenv('STATIC_MAX_AGE', 3600))  # seconds, for everything but HTML
+STATIC_PRELOAD_MAX_BYTES = 4 * 1024 * 1024
+_STATIC_RECHECK_SECONDS = 2.0
+
+class StaticAssets:
+    """In-memory copies of the files under root, keyed by URL path relative to it."""
+
+    def __init__(self, root: pathlib.Path):
+        self.root = root
+        self.assets: dict[str, dict] = {}
+        self.loaded = False
+        self.hits = self.not_modified = 0
+
+    def load(self):
+        assets = {}
+        for dirpath, _, filenames in os.walk(self.root):
+            for name in filenames:
+                path = pathlib.Path(dirpath) / name
+                entry = self._load_file(path)
+                if entry is not None:
+                    assets[path.relative_to(self.root).as_posix()] = entry
+        self.assets = assets
+        self.loaded = True
+
+    @staticmethod
+    def _load_file(path: pathlib.Path) -> dict | None:
+        try:
+            st = path.stat()
+            if st.st_size > STATIC_PRELOAD_MAX_BYTES:
+                return None  # served from disk instead
+            raw = path.read_bytes()
+        except OSError:
+            return None
+        content_type = mimetypes.guess_type(path.name)[0] or 'application/octet-stream'
+        bodies = {'identity': raw}
+        if content_type.startswith(_COMPRESSIBLE_TYPES) and len(raw) >= 256:
+            # Compressed once, so use the highest levels
+            if brotli is not None:
+                bodies['br'] = brotli.compress(raw, quality=11)
+            bodies['gzip'] = gzip.compress(raw, compresslevel=9)
+        return {
+            'path': path,
+            'type': content_type,
+            'bodies': bodies,
+            'etag': hashlib.sha256(raw).hexdigest()[:24],
+            'last_modified': email.utils.formatdate(st.st_mtime, usegmt=True),
+            'stat': (st.st_mtime_ns, st.st_size),
+            'checked': time.monotonic(),
+        }
+
+    async def lookup(self, rel: str) -> dict | None:
+        if not self.loaded:
+            await file_call(self.load)
+        if rel == '' or rel.endswith('/'):
+            rel += 'index.html'
+        entry = self.assets.get(rel)
+        if entry is not None and time.monotonic() - entry['checked'] > _STATIC_RECHECK_SECONDS:
+            entry['checked'] = time.monotonic()
+            asyncio.create_task(self._refresh(rel, entry))
+        return entry
+
+    async def _refresh(self, rel: str, entry: dict):
+        changed, fresh = await file_call(self._reload_if_changed, entry)
+        if changed and self.assets.get(rel) is entry:
+            if fresh is None:
+                self.assets.pop(rel, None)
+            else:
+                self.assets[rel] = fresh
+
+    @classmethod
+    def _reload_if_changed(cls, entry: dict) -> tuple[bool, dict | None]:
+        """(changed, new entry or None if the file is gone or too large now)."""
+        try:
+            st = entry['path'].stat()
+            if (st.st_mtime_ns, st.st_size) == entry['stat']:
+                return False, entry
+        except OSError:
+            pass
+        return True, cls._load_file(entry['path'])
+
+    def respond(self, request: web.Request, entry: dict) -> web.Response:
+        accepted = {e.split(';')[0].strip() for e in request.headers.get('Accept-Encoding', '').split(',')}
+        encoding = next((e for e in ('br', 'gzip') if e in entry['bodies'] and e in accepted), 'identity')
+        etag = f'"{entry["etag"]}"' if encoding == 'identity' else f'"{entry["etag"]}-{encoding}"'
+        headers = {
+            'ETag': etag,
+            'Last-Modified': entry['last_modified'],
+            # Pages are not versioned by URL, so they are revalidated every time
+            'Cache-Control': 'no-cache' if entry['type'] == 'text/html' else f'public, max-age={STATIC_MAX_AGE}',
+            'Vary': 'Accept-Encoding',
+        }
+        if etag in request.headers.get('If-None-Match', ''):
+            self.not_modified += 1
+            return web.Response(status=304, headers=headers)
+        self.hits += 1
+        if encoding != 'identity':
+            headers['Content-Encoding'] = encoding
+        charset = 'utf-8' if entry['type'].startswith('text/') or entry['type'] == 'application/javascript' else None
+        return web.Response(body=entry['bodies'][encoding], content_type=entry['type'], charset=charset, headers=headers)
+
+    def stats(self) -> dict:
+        return {
+            'files': len(self.assets),
+            'bytes': sum(len(b) for e in self.assets.values() for b in e['bodies'].values()),
+            'hits': self.hits,
+            'notModified': self.not_modified,
+        }
+
+
+static_assets = StaticAssets(STATIC_ROOT)
+
+async def serve_static(request):
+    rel = request.match_info['path']
+    entry = await static_assets.lookup(rel)
+    if entry is not None:
+        return static_assets.respond(request, entry)
+    # Not preloaded (too large, or added since): fall back to the file on disk
+    root = str(STATIC_ROOT)
+    target = os.path.normpath(os.path.join(root, rel))
+    if target.startswith(root + os.sep) and os.path.isfile(target):
+        return web.FileResponse(target)
+    # SPA route: any other path gets index.html
+    entry = await static_assets.lookup('index.html')
+    if entry is None:
+        raise web.HTTPNotFound()
+    return static_assets.respond(request, entry)
+
+# Workspace file transfer over HTTP, for files too large or too binary for a
+# single JSON message:
+#   GET/HEAD /files/<path>            byte ranges, conditional requests, sendfile
+#   GET      /uploads/<path>          {"offset"} already received for a resumable upload
+#   PUT      /uploads/<path>?offset=N[&complete=1]
+#                                     append the body at offset N; complete=1 moves
+#                                     the finished upload into place
+# Errors are returned as JSON responses.
+
+def _resolve_in_workdir(rel_path: str) -> pathlib.Path:
+    """Resolve a client-supplied relative path, refusing anything outside WORK_DIR."""
+    root = WORK_DIR.resolve()
+    target = (root / rel_path).resolve()
+    if target != root and root not in target.parents:
+        raise PermissionError(f"Path escapes the workspace: {rel_path}")
+    return target
+
+def _upload_path(target: pathlib.Path) -> pathlib.Path:
+    """Hidden partial file an upload to target is assembled in; target must be a file path inside WORK_DIR."""
+    root = WORK_DIR.resolve()
+    if target == root or target.is_dir():
+        raise IsADirectoryError(f"Upload target is a directory: {os.path.relpath(target, root)}")
+    partial = target.with_name(f".{target.name}.upload")
+    if root not in partial.parents:
+        raise PermissionError(f"Path escapes the workspace: {partial.name}")
+    return partial
+
+def _append_upload_sync(partial: pathlib.Path, offset: int, data: bytes) -> int:
+    """Write data at offset into a partial upload (truncating anything after it); returns the new size."""
+    partial.parent.mkdir(parents=True, exist_ok=True)
+    with open(partial, 'r+b' if partial.exists() else 'wb') as f:
+        f.seek(offset)
+        f.write(data)
+        f.truncate()
+        return f.tell()
+
+def _upload_offset(partial: pathlib.Path) -> int:
     try:
-        return await handler(request)
-    except web.HTTPNotFound:
-        # Serve index.html for SPA routing
-        return web.FileResponse(STATIC_ROOT / 'index.html')
+        return partial.stat().st_size
+    except FileNotFoundError:
+        return 0
 
-app = web.Application(middlewares=[spa_fallback])
-app.router.add_get('/health', health)
-app.router.add_static('/', STATIC_ROOT, show_index=True)
+async def get_workspace_file(request):
+    try:
+        target = _resolve_in_workdir(request.match_info['path'])
+    except PermissionError as e:
+        return web.json_response({'error': str(e)}, status=403)
+    if not target.is_file():
+        return web.json_response({'error': 'File not found'}, status=404)
+    return web.FileResponse(target, headers={'Cache-Control': 'no-cache'})
 
-# WebSocket handler and streaming utilities
-async def stream_pipe(pipe, name, ws, buffer):
+async def get_upload_status(request):
     try:
-        while True:
-            chunk = await pipe.readline()
-            if not chunk:
-                break
-            data = chunk.decode()
-            if name == 'stdout':
-                buffer.append(data)
-            await ws.send(json.dumps({'type': 'stream', 'stream': name, 'data': data}))
-    except asyncio.CancelledError:
-        # Stream was cancelled, this is expected
-        raise
-    except Exception as e:
-        # Handle other errors gracefully
-        print(f"Error in stream_pipe: {e}", file=sys.stderr)
+        partial = _upload_path(_resolve_in_workdir(request.match_info['path']))
+    except OSError as e:
+        return web.json_response({'error': str(e)}, status=403)
+    return web.json_response({'path': request.match_info['path'], 'offset': _upload_offset(partial)})
 
-async def monitor_frontend_process(port: int, proc: asyncio.subprocess.Process):
-    """Monitor a frontend process and clean up when it exits"""
+async def put_upload(request):
     try:
-        await proc.wait()
-        print(f"Frontend server on port {port} exited with code {proc.returncode}", file=sys.stderr)
-        if proc.returncode != 0:
-            stdout, stderr = await proc.communicate()
-            print(f"Frontend server error output:", file=sys.stderr)
-            print(f"stdout: {stdout.decode()}", file=sys.stderr)
-            print(f"stderr: {stderr.decode()}", file=sys.stderr)
-    except Exception as e:
-        print(f"Error monitoring frontend process on port {port}: {e}", file=sys.stderr)
-    finally:
-        frontend_processes.pop(port, None)
+        target = _resolve_in_workdir(request.match_info['path'])
+        partial = _upload_path(target)
+        offset = int(request.query.get('offset', 0))
+    except (OSError, ValueError) as e:
+        return web.json_response({'error': str(e)}, status=400)
+    current = await file_call(_upload_offset, partial)
+    if offset > current:
+        return web.json_response({'error': 'Offset beyond received data', 'offset': current}, status=409)
+    if offset + (request.content_length or 0) > MAX_UPLOAD_BYTES:
+        return web.json_response({'error': f'Upload exceeds {MAX_UPLOAD_BYTES} bytes'}, status=413)
+    try:
+        async for chunk in request.content.iter_chunked(FILE_CHUNK_SIZE):
+            if offset + len(chunk) > MAX_UPLOAD_BYTES:
+                return web.json_response({'error': f'Upload exceeds {MAX_UPLOAD_BYTES} bytes', 'offset': offset}, status=413)
+            offset = await file_call(_append_upload_sync, partial, offset, chunk)
+        if offset == current == 0 and not partial.exists():
+            await file_call(_append_upload_sync, partial, 0, b'')  # empty file
+        complete = request.query.get('complete') in ('1', 'true')
+        if complete:
+            await file_call(os.replace, partial, target)
+    except OSError as e:
+        return web.json_response({'error': str(e), 'offset': _upload_offset(partial)}, status=500)
+    return web.json_response({'path': request.match_info['path'], 'offset': offset, 'complete': complete})
 
-async def stop_frontend_server(port: int):
-    """Stop a frontend server running on the specified port"""
-    if port in frontend_processes:
+app = web.Application()
+app.router.add_get('/health', health)
+app.router.add_get('/files/{path:.+}', get_workspace_file)
+app.router.add_get('/uploads/{path:.+}', get_upload_status)
+app.router.add_put('/uploads/{path:.+}', put_upload)
+app.router.add_get('/{path:.*}', serve_static)
+
+# Outbound WebSocket queues: every connection gets a bounded queue drained by its
+# own writer task, so a slow browser never stalls reading gemini's pipes.
+# Past SEND_QUEUE_SOFT_LIMIT bytes of queued stream output, stderr frames are
+# dropped; past SEND_QUEUE_HARD_LIMIT the client is disconnected. Control frames
+# (replies, run status, file events, search results) are never dropped but have
+# their own budget, SEND_QUEUE_CONTROL_LIMIT, sized to fit the largest file
+# reply. Sizes are UTF-8 bytes.
+SEND_QUEUE_SOFT_LIMIT = int(os.getenv('SEND_QUEUE_SOFT_LIMIT', 1024 * 1024))
+SEND_QUEUE_HARD_LIMIT = int(os.getenv('SEND_QUEUE_HARD_LIMIT', 8 * 1024 * 1024))
+SEND_QUEUE_CONTROL_LIMIT = int(os.getenv('SEND_QUEUE_CONTROL_LIMIT', 64 * 1024 * 1024))
+
+_channels: "weakref.WeakSet[ClientChannel]" = weakref.WeakSet()
+
+
+class ClientChannel:
+    """
+    Non-blocking sender for one WebSocket connection.
+    send() queues a serialized control frame; send_stream() queues a stream
+    frame that may be merged with the previous one (same stream and
+    conversation; the merged frame keeps the latest extra fields, e.g. seq),
+    or dropped under pressure when it is stderr noise.
+    """
+
+    FRAME_OVERHEAD = 64  # rough JSON envelope size of a stream frame
+
+    def __init__(self, ws):
+        self.ws = ws
+        self.queue: deque = deque()  # [frame, size]: str (control) or dict (stream frame)
+        self.queued_bytes = 0
+        self.stream_bytes = 0  # stream frames, limited by SEND_QUEUE_SOFT/HARD_LIMIT
+        self.control_bytes = 0  # control frames, limited by SEND_QUEUE_CONTROL_LIMIT
+        self.sent_frames = 0
+        self.sent_bytes = 0
+        self.dropped_frames = 0
+        self.dropped_bytes = 0
+        self.coalesced_frames = 0
+        self.closed = False
+        self._wakeup = asyncio.Event()
+        self._writer = asyncio.create_task(self._write_loop())
+        _channels.add(self)
+
+    async def send(self, message: str):
+        if self.closed:
+            return
+        size = len(message.encode('utf-8'))
+        self.queue.append([message, size])
+        self.queued_bytes += size
+        self.control_bytes += size
+        self._after_enqueue()
+
+    async def send_stream(self, stream: str, data: str, **fields):
+        if self.closed or not data:
+            return
+        size = len(data.encode('utf-8'))
+        if stream == 'stderr' and self.stream_bytes + size > SEND_QUEUE_SOFT_LIMIT:
+            self.dropped_frames += 1
+            self.dropped_bytes += size
+            return
+        last = self.queue[-1] if self.queue else None
+        if (last is not None and isinstance(last[0], dict) and last[0]['stream'] == stream
+                and last[0].get('conversationId') == fields.get('conversationId')):
+            last[0]['data'] += data
+            last[0].update(fields)
+            last[1] += size
+            self.coalesced_frames += 1
+        else:
+            size += self.FRAME_OVERHEAD
+            self.queue.append([{'type': 'stream', 'stream': stream, 'data': data, **fields}, size])
+        self.queued_bytes += size
+        self.stream_bytes += size
+        self._after_enqueue()
+
+    def _after_enqueue(self):
+        if self.stream_bytes > SEND_QUEUE_SOFT_LIMIT:
+            self._shed_stderr()
+        if self.stream_bytes > SEND_QUEUE_HARD_LIMIT or self.control_bytes > SEND_QUEUE_CONTROL_LIMIT:
+            print(f"WebSocket client too slow ({self.stream_bytes} bytes of output and "
+                  f"{self.control_bytes} bytes of control frames queued), disconnecting", file=sys.stderr)
+            self.close(code=1013, reason='Client too slow')
+            return
+        self._wakeup.set()
+
+    def _shed_stderr(self):
+        kept = deque()
+        for item in self.queue:
+            frame, size = item
+            if isinstance(frame, dict) and frame['stream'] == 'stderr':
+                self.dropped_frames += 1
+                self.dropped_bytes += size - self.FRAME_OVERHEAD
+                self.queued_bytes -= size
+                self.stream_bytes -= size
+            else:
+                kept.append(item)
+        self.queue = kept
+
+    async def _write_loop(self):
         try:
-            proc = frontend_processes[port]
-            print(f"Stopping frontend server on port {port}", file=sys.stderr)
-            proc.terminate()
-            try:
-                await asyncio.wait_for(proc.wait(), timeout=5.0)
-                print(f"Frontend server on port {port} stopped gracefully", file=sys.stderr)
-            except asyncio.TimeoutError:
-                print(f"Frontend server on port {port} didn't stop gracefully, killing", file=sys.stderr)
-                proc.kill()
-                await proc.wait()
-            return True
+            while True:
+                await self._wakeup.wait()
+                self._wakeup.clear()
+                while self.queue:
+                    frame, size = self.queue.popleft()
+                    self.queued_bytes -= size
+                    if isinstance(frame, dict):
+                        self.stream_bytes -= size
+                        frame = json.dumps(frame)
+                    else:
+                        self.control_bytes -= size
+                    await self.ws.send(frame)
+                    self.sent_frames += 1
+                    self.sent_bytes += size
+        except asyncio.CancelledError:
+            pass
         except Exception as e:
-            print(f"Error stopping frontend server on port {port}: {e}", file=sys.stderr)
-            return False
+            # Connection closed under us; stop accepting frames
+            print(f"WebSocket writer stopped: {e}", file=sys.stderr)
         finally:
-            frontend_processes.pop(port, None)
-    else:
-        print(f"No frontend server running on port {port}", file=sys.stderr)
+            self.closed = True
+            self.queue.clear()
+            self.queued_bytes = self.stream_bytes = self.control_bytes = 0
+
+    def close(self, code: int = 1000, reason: str = ''):
+        if self.closed:
+            return
+        self.closed = True
+        self.queue.clear()
+        self.queued_bytes = self.stream_bytes = self.control_bytes = 0
+        self._writer.cancel()
+        asyncio.create_task(self.ws.close(code=code, reason=reason))
+
+    def stats(self) -> dict:
+        return {
+            'queuedBytes': self.queued_bytes,
+            'controlBytes': self.control_bytes,
+            'queuedFrames': len(self.queue),
+            'sentFrames': self.sent_frames,
+            'sentBytes': self.sent_bytes,
+            'droppedFrames': self.dropped_frames,
+            'droppedBytes': self.dropped_bytes,
+            'coalescedFrames': self.coalesced_frames,
+        }
+
+
+def send_queue_stats() -> dict:
+    channels = [c.stats() for c in list(_channels) if not c.closed]
+    totals = {k: sum(c[k] for c in channels) for k in ('queuedBytes', 'sentFrames', 'droppedFrames', 'droppedBytes')}
+    return {'connections': len(channels), **totals, 'perConnection': channels}
+
+# File operations requested over the WebSocket run on a small dedicated pool so
+# large reads and writes never stall streaming on the event loop.
+FILE_IO_WORKERS = int(os.getenv('FILE_IO_WORKERS', 4))
+MAX_FILE_READ_BYTES = int(os.getenv('MAX_FILE_READ_BYTES', 10 * 1024 * 1024))
+MAX_FILE_WRITE_BYTES = int(os.getenv('MAX_FILE_WRITE_BYTES', 10 * 1024 * 1024))
+# Chunked transfer (HTTP /files and /uploads, WS read_file_chunk/write_file_chunk)
+FILE_CHUNK_SIZE = 64 * 1024
+MAX_FILE_CHUNK_BYTES = int(os.getenv('MAX_FILE_CHUNK_BYTES', 4 * 1024 * 1024))
+MAX_UPLOAD_BYTES = int(os.getenv('MAX_UPLOAD_BYTES', 2 * 1024 * 1024 * 1024))
+_file_executor = ThreadPoolExecutor(max_workers=FILE_IO_WORKERS, thread_name_prefix='file-io')
+
+async def file_call(fn, *args):
+    """Run a blocking file operation on the file I/O pool."""
+    return await asyncio.get_running_loop().run_in_executor(_file_executor, fn, *args)
+
+def _list_files_sync(work_dir: pathlib.Path) -> list[str]:
+    with os.scandir(work_dir) as it:
+        return [e.name for e in it if e.is_file()]
+
+# Decode/encode in slices so the worker thread gives the GIL back to the event loop in between
+_FILE_IO_CHUNK = 256 * 1024
+
+def _read_file_sync(path: pathlib.Path) -> str:
+    size = path.stat().st_size
+    if size > MAX_FILE_READ_BYTES:
+        raise ValueError(f"File too large to open ({size} bytes, limit {MAX_FILE_READ_BYTES})")
+    decoder = codecs.getincrementaldecoder('utf-8')()
+    parts = []
+    with open(path, 'rb') as f:
+        while chunk := f.read(_FILE_IO_CHUNK):
+            parts.append(decoder.decode(chunk))
+    parts.append(decoder.decode(b'', final=True))
+    return ''.join(parts)
+
+def _read_chunk_sync(path: pathlib.Path, offset: int, length: int) -> tuple[bytes, int]:
+    """Read up to length bytes at offset; returns (data, file size)."""
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        f.seek(offset)
+        return f.read(length), size
+
+# .geminiignore handling (gitignore syntax, root file only)
+_ALWAYS_PRUNED_DIRS = {'.git', 'node_modules'}
+
+def _glob_to_regex(pattern: str) -> str:
+    """Translate one gitignore glob (no leading/trailing slash handling) to a regex body."""
+    out, i, n = [], 0, len(pattern)
+    while i < n:
+        c = pattern[i]
+        if pattern.startswith('**/', i):
+            out.append('(?:.*/)?')
+            i += 3
+        elif pattern.startswith('/**', i) and i + 3 == n:
+            out.append('(?:/.*)?')
+            i += 3
+        elif pattern.startswith('**', i):
+            out.append('.*')
+            i += 2
+        elif c == '*':
+            out.append('[^/]*')
+            i += 1
+        elif c == '?':
+            out.append('[^/]')
+            i += 1
+        elif c == '[':
+            end = pattern.find(']', i + 1)
+            if end == -1:
+                out.append(re.escape(c))
+                i += 1
+            else:
+                body = pattern[i + 1:end]
+                if body.startswith('!'):
+                    body = '^' + body[1:]
+                out.append('[' + body + ']')
+                i = end + 1
+        elif c == '\\' and i + 1 < n:
+            out.append(re.escape(pattern[i + 1]))
+            i += 2
+        else:
+            out.append(re.escape(c))
+            i += 1
+    return ''.join(out)
+
+def parse_ignore_line(line: str):
+    """
+    Parse one .geminiignore line into (kind, pattern, negated, dir_only), or None
+    for blanks/comments. kind is 'name' (a literal file name), 'name_glob' (a glob
+    on the file name alone) or 'path' (a regex for the whole relative path).
+    Text after whitespace + '#' is treated as a comment, since the shipped file
+    annotates some patterns that way.
+    """
+    line = re.sub(r'\s+#.*$', '', line.rstrip('\n'))
+    line = line.rstrip()
+    if not line or line.startswith('#'):
+        return None
+    negated = line.startswith('!')
+    if negated:
+        line = line[1:]
+    if line.startswith('\\#') or line.startswith('\\!'):
+        line = line[1:]
+    dir_only = line.endswith('/')
+    line = line.rstrip('/')
+    if not line:
+        return None
+    if line.startswith('**/') and '/' not in line[3:] and '**' not in line[3:]:
+        line = line[3:]  # '**/x' is the same as an unanchored 'x'
+    if '/' not in line and '**' not in line:
+        # No slash: the pattern matches the last path component at any depth
+        if not any(c in line for c in '*?[\\'):
+            return 'name', line, negated, dir_only
+        return 'name_glob', _glob_to_regex(line), negated, dir_only
+    prefix = '' if '/' in line else '(?:.*/)?'
+    return 'path', prefix + _glob_to_regex(line.lstrip('/')), negated, dir_only
+
+
+class IgnoreMatcher:
+    """
+    A .geminiignore compiled for fast lookups. gitignore semantics make the last
+    matching rule win, so consecutive rules with the same sign and dir-only flag
+    are merged into one group (a set of literal names plus one combined regex per
+    kind) and groups are tried last to first; the first group that matches decides.
+    Most paths match no rule at all, so one combined check of every non-negated
+    rule runs first.
+    Callers walking a tree prune ignored directories, so only the entry itself is
+    checked; use ignored_path for an arbitrary path.
+    """
+
+    def __init__(self, lines=()):
+        groups = []
+        for rule in map(parse_ignore_line, lines):
+            if rule is None:
+                continue
+            kind, pattern, negated, dir_only = rule
+            if not groups or groups[-1][:2] != [negated, dir_only]:
+                groups.append([negated, dir_only, set(), [], []])
+            group = groups[-1]
+            if kind == 'name':
+                group[2].add(pattern)
+            else:
+                group[3 if kind == 'name_glob' else 4].append(pattern)
+        self.groups = []
+        self.rule_count = 0
+        for negated, dir_only, names, name_globs, paths in reversed(groups):
+            self.rule_count += len(names) + len(name_globs) + len(paths)
+            self.groups.append((negated, dir_only, frozenset(names),
+                                self._combine(name_globs), self._combine(paths)))
+        # Prefilters: (names, name regex, path regex) over all positive rules, for dirs and for files
+        self._any = {}
+        for is_dir in (True, False):
+            picked = [g for g in groups if not g[0] and (is_dir or not g[1])]
+            self._any[is_dir] = (frozenset().union(*(g[2] for g in picked)),
+                                 self._combine([p for g in picked for p in g[3]]),
+                                 self._combine([p for g in picked for p in g[4]]))
+
+    @staticmethod
+    def _combine(patterns: list):
+        if not patterns:
+            return None
+        try:
+            return re.compile('(?:' + '|'.join(patterns) + r')\Z')
+        except re.error:
+            # One bad pattern should not disable the others
+            valid = []
+            for p in patterns:
+                try:
+                    re.compile(p)
+                    valid.append(p)
+                except re.error:
+                    pass
+            return re.compile('(?:' + '|'.join(valid) + r')\Z') if valid else None
+
+    def ignored(self, rel_path: str, is_dir: bool, name: str | None = None) -> bool:
+        if name is None:
+            name = rel_path.rpartition('/')[2]
+        names, name_rx, path_rx = self._any[is_dir]
+        if not (name in names or (name_rx and name_rx.match(name)) or (path_rx and path_rx.match(rel_path))):
+            return False
+        for negated, dir_only, names, name_rx, path_rx in self.groups:
+            if dir_only and not is_dir:
+                continue
+            if name in names or (name_rx and name_rx.match(name)) or (path_rx and path_rx.match(rel_path)):
+                return not negated
         return False
 
-async def start_frontend_server(port: int, work_dir: pathlib.Path):
-    """Start a frontend server using npx serve (or gemmit-npx in production)"""
+    def ignored_path(self, rel_path: str, is_dir: bool) -> bool:
+        """Like ignored, but also true when any parent directory is ignored."""
+        parts = rel_path.split('/')
+        for i in range(1, len(parts)):
+            if self.ignored('/'.join(parts[:i]), True, parts[i - 1]):
+                return True
+        return self.ignored(rel_path, is_dir, parts[-1])
+
+
+_ignore_matchers: dict[str, tuple] = {}  # root -> ((mtime_ns, size) or None, IgnoreMatcher)
+
+def ignore_matcher(root: pathlib.Path) -> IgnoreMatcher:
+    """The compiled .geminiignore for root, recompiled only when the file changes."""
+    path = root / '.geminiignore'
     try:
-        # Kill existing server on this port if it exists
-        if port in frontend_processes:
+        st = path.stat()
+        key = (st.st_mtime_ns, st.st_size)
+    except OSError:
+        key = None
+    cached = _ignore_matchers.get(str(root))
+    if cached is not None and cached[0] == key:
+        return cached[1]
+    lines = []
+    if key is not None:
+        try:
+            lines = path.read_text(encoding='utf-8', errors='replace').splitlines()
+        except OSError:
+            pass
+    matcher = IgnoreMatcher(lines)
+    _ignore_matchers[str(root)] = (key, matcher)
+    return matcher
+
+# Recursive tree listing
+TREE_PAGE_DEFAULT = 1000
+TREE_PAGE_MAX = 5000
+TREE_WALK_BUDGET = float(os.getenv('TREE_WALK_BUDGET', 2.0))  # seconds per page
+
+def _list_tree_sync(work_dir: pathlib.Path, sub_path: str = '', cursor: str | None = None,
+                    limit: int = TREE_PAGE_DEFAULT, max_depth: int | None = None) -> dict:
+    """
+    One page of a depth-first, name-ordered walk of work_dir (or sub_path inside it).
+    Ignored paths are pruned as the walk goes, so ignored trees are never entered.
+    The returned nextCursor is the path of the last entry; pass it back to continue.
+    It is None only once the walk is complete: a page whose time budget ran out
+    before it found anything returns the cursor it started from ('' for the top).
+    """
+    root = _resolve_in_workdir(sub_path) if sub_path else work_dir
+    matcher = ignore_matcher(work_dir)
+    cursor_parts = tuple(cursor.split('/')) if cursor else ()
+    deadline = time.monotonic() + TREE_WALK_BUDGET
+    entries: list[dict] = []
+    base_rel = root.relative_to(work_dir.resolve()).as_posix() if sub_path else ''
+    timed_out = False
+
+    def walk(rel_dir: str, depth: int) -> bool:
+        """Returns False once the page is full or the time budget ran out."""
+        nonlocal timed_out
+        try:
+            with os.scandir(root / rel_dir if rel_dir else root) as it:
+                children = sorted(it, key=lambda e: e.name)
+        except OSError:
+            return True
+        for entry in children:
+            rel = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+            parts = tuple(rel.split('/'))
             try:
-                frontend_processes[port].terminate()
-                await asyncio.wait_for(frontend_processes[port].wait(), timeout=5.0)
-            except asyncio.TimeoutError:
-                frontend_processes[port].kill()
-                await frontend_processes[port].wait()
-            finally:
-                del frontend_processes[port]
+                is_dir = entry.is_dir(follow_symlinks=False)
+            except OSError:
+                continue
+            # Name-sorted depth-first order is tuple order on path parts, so anything
+            # <= the cursor was returned earlier; only the cursor's ancestors and
+            # the cursor itself still need descending into.
+            seen = bool(cursor_parts) and parts <= cursor_parts
+            if seen and parts != cursor_parts[:len(parts)]:
+                continue
+            ws_rel = f"{base_rel}/{rel}" if base_rel else rel
+            if is_dir and entry.name in _ALWAYS_PRUNED_DIRS:
+                continue
+            if matcher.ignored(ws_rel, is_dir, entry.name):
+                continue
+            if not seen:
+                if len(entries) >= limit:
+                    return False
+                if time.monotonic() > deadline:
+                    timed_out = True
+                    return False
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except OSError:
+                    continue
+                entries.append({
+                    'path': ws_rel,
+                    'name': entry.name,
+                    'type': 'dir' if is_dir else ('symlink' if entry.is_symlink() else 'file'),
+                    'size': st.st_size if not is_dir else None,
+                    'mtime': st.st_mtime,
+                    'depth': depth,
+                })
+            if is_dir and (max_depth is None or depth < max_depth):
+                if not walk(rel, depth + 1):
+                    return False
+        return True
+
+    complete = walk('', 0)
+    next_cursor = None
+    if not complete and entries:
+        last = entries[-1]['path']
+        next_cursor = last[len(base_rel) + 1:] if base_rel else last
+    elif not complete:
+        next_cursor = cursor or ''  # budget ran out before anything new was found
+    return {'entries': entries, 'nextCursor': next_cursor, 'timedOut': timed_out}
+
+def _atomic_write_sync(path: pathlib.Path, content: str):
+    """Write via a temp file in the same directory and rename it over the target."""
+    too_large = f"File too large to save (limit {MAX_FILE_WRITE_BYTES} bytes)"
+    if len(content) > MAX_FILE_WRITE_BYTES:  # every character is at least one byte
+        raise ValueError(too_large)
+    tmp = path.with_name(f".{path.name}.{uuid.uuid4().hex[:8]}.tmp")
+    try:
+        with open(tmp, 'wb') as f:
+            size = 0
+            for start in range(0, len(content), _FILE_IO_CHUNK):
+                data = content[start:start + _FILE_IO_CHUNK].encode('utf-8')
+                size += len(data)
+                if size > MAX_FILE_WRITE_BYTES:
+                    raise ValueError(too_large)
+                f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        try:
+            shutil.copymode(path, tmp)  # keep e.g. the executable bit of an existing file
+        except OSError:
+            pass
+        os.replace(tmp, path)
+    except BaseException:
+        tmp.unlink(missing_ok=True)
+        raise
+
+# Workspace watcher
+# Keeps an index of the (non-ignored) tree under WORK_DIR and pushes debounced
+# file_created / file_changed / file_deleted events to clients that sent `watch`.
+# Linux uses inotify (one watch per directory); elsewhere, or when inotify is
+# unavailable or out of watches, the tree is rescanned every WATCH_POLL_INTERVAL.
+WATCH_BACKEND = os.getenv('WATCH_BACKEND', 'auto').lower()  # auto | inotify | poll
+WATCH_POLL_INTERVAL = float(os.getenv('WATCH_POLL_INTERVAL', 2.0))  # seconds
+WATCH_DEBOUNCE = float(os.getenv('WATCH_DEBOUNCE_MS', 150)) / 1000
+WATCH_EVENTS_PER_FRAME = 2000
+_WATCH_SKIP_DIRS = _ALWAYS_PRUNED_DIRS | {'.gemmit'}  # .gemmit is our own state
+
+def _entry_state(st: os.stat_result) -> tuple:
+    """(kind, size, mtime_ns) as stored in the watcher index."""
+    if stat.S_ISDIR(st.st_mode):
+        return 'dir', None, st.st_mtime_ns
+    return ('symlink' if stat.S_ISLNK(st.st_mode) else 'file'), st.st_size, st.st_mtime_ns
+
+def _watch_skipped(rel: str, is_dir: bool, matcher: IgnoreMatcher) -> bool:
+    name = rel.rpartition('/')[2]
+    return (is_dir and name in _WATCH_SKIP_DIRS) or matcher.ignored(rel, is_dir, name)
+
+def _scan_tree_sync(root: pathlib.Path, matcher: IgnoreMatcher, start: str = '') -> dict[str, tuple]:
+    """Index every non-ignored path below root/start, pruning ignored directories."""
+    index: dict[str, tuple] = {}
+    pending = [start]
+    while pending:
+        rel_dir = pending.pop()
+        try:
+            with os.scandir(root / rel_dir if rel_dir else root) as it:
+                entries = list(it)
+        except OSError:
+            continue
+        for entry in entries:
+            rel = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+            try:
+                state = _entry_state(entry.stat(follow_symlinks=False))
+            except OSError:
+                continue
+            is_dir = state[0] == 'dir'
+            if _watch_skipped(rel, is_dir, matcher):
+                continue
+            index[rel] = state
+            if is_dir:
+                pending.append(rel)
+    return index
+
+def _probe_paths_sync(root: pathlib.Path, matcher: IgnoreMatcher, paths: set, known: set) -> dict[str, tuple | None]:
+    """Current state of each path (None if gone); directories not in known are scanned in full."""
+    updates: dict[str, tuple | None] = {}
+    for rel in paths:
+        try:
+            state = _entry_state(os.lstat(root / rel))
+        except OSError:
+            updates[rel] = None
+            continue
+        if _watch_skipped(rel, state[0] == 'dir', matcher):
+            continue
+        updates[rel] = state
+        if state[0] == 'dir' and rel not in known:
+            # A new directory may already have contents by the time it is watched
+            updates.update(_scan_tree_sync(root, matcher, rel))
+    return updates
+
+
+class _Inotify:
+    """Minimal ctypes binding: one non-blocking inotify fd with per-directory watches."""
+    IN_MODIFY, IN_ATTRIB, IN_CLOSE_WRITE = 0x2, 0x4, 0x8
+    IN_MOVED_FROM, IN_MOVED_TO, IN_CREATE, IN_DELETE = 0x40, 0x80, 0x100, 0x200
+    IN_DELETE_SELF, IN_MOVE_SELF = 0x400, 0x800
+    IN_Q_OVERFLOW, IN_IGNORED, IN_ONLYDIR, IN_ISDIR = 0x4000, 0x8000, 0x01000000, 0x40000000
+    MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE
+            | IN_DELETE | IN_DELETE_SELF | IN_MOVE_SELF | IN_ONLYDIR)
+    _EVENT = struct.Struct('iIII')
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        self.dirs: dict[int, str] = {}  # wd -> directory path relative to the root
+        self.watched: set[str] = set()
+
+    def add(self, root: pathlib.Path, rel: str):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(root / rel if rel else root), self.MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOENT or err == errno.ENOTDIR:
+                return  # gone again before we got to it
+            raise OSError(err, os.strerror(err))
+        self.dirs[wd] = rel
+        self.watched.add(rel)
+
+    def read(self) -> list[tuple[str | None, int]]:
+        """Drain pending events as (path relative to the root, mask); path is None for overflow."""
+        events = []
+        while True:
+            try:
+                buf = os.read(self.fd, 64 * 1024)
+            except BlockingIOError:
+                return events
+            offset = 0
+            while offset < len(buf):
+                wd, mask, _cookie, length = self._EVENT.unpack_from(buf, offset)
+                name = buf[offset + self._EVENT.size:offset + self._EVENT.size + length].rstrip(b'\0')
+                offset += self._EVENT.size + length
+                if mask & self.IN_Q_OVERFLOW:
+                    events.append((None, mask))
+                    continue
+                rel_dir = self.dirs.get(wd)
+                if mask & self.IN_IGNORED:
+                    self.dirs.pop(wd, None)
+                    self.watched.discard(rel_dir)
+                    continue
+                if rel_dir is None:
+                    continue
+                if name:
+                    name = os.fsdecode(name)
+                    events.append((f"{rel_dir}/{name}" if rel_dir else name, mask))
+                else:
+                    events.append((rel_dir, mask))  # the watched directory itself
+
+    def close(self):
+        os.close(self.fd)
+
+
+class WorkspaceWatcher:
+    """
+    Watches one root for the clients subscribed to it; stops when the last one leaves.
+    Subscribers only need .closed and async send(str). With use_ignore_file=False
+    .geminiignore is not applied (previews serve e.g. dist/, which it lists).
+    """
+
+    def __init__(self, use_ignore_file: bool = True):
+        self.use_ignore_file = use_ignore_file
+        self.root: pathlib.Path | None = None
+        self.backend: str | None = None
+        self.subscribers: set[ClientChannel] = set()
+        self.index: dict[str, tuple] = {}
+        self.matcher = IgnoreMatcher()
+        self.events_sent = 0
+        self._inotify: _Inotify | None = None
+        self._poll_task: asyncio.Task | None = None
+        self._flush_handle: asyncio.TimerHandle | None = None
+        self._dirty: set[str] = set()
+        self._rescan = False
+        self._generation = 0
+        self._lock = asyncio.Lock()
+
+    def _live_subscribers(self):
+        self.subscribers = {c for c in self.subscribers if not c.closed}
+        return list(self.subscribers)
+
+    async def watch(self, channel: ClientChannel, root: pathlib.Path) -> dict:
+        self.subscribers.add(channel)
+        if self.backend is None or self.root != root:
+            await self._start(root)
+        return {'root': str(self.root), 'backend': self.backend, 'entries': len(self.index)}
+
+    def unwatch(self, channel: ClientChannel):
+        self.subscribers.discard(channel)
+        if self.backend is not None and not self._live_subscribers():
+            self._stop()
+
+    async def reroot(self, root: pathlib.Path):
+        """Follow a change of WORK_DIR, if anyone is watching."""
+        if self.backend is None or root == self.root:
+            return
+        await self._start(root)
+        message = json.dumps({'type': 'watch_result', 'watching': True, 'rerooted': True,
+                              'root': str(self.root), 'backend': self.backend, 'entries': len(self.index)})
+        for channel in self._live_subscribers():
+            await channel.send(message)
+
+    async def _start(self, root: pathlib.Path):
+        self._stop()
+        generation = self._generation
+        async with self._lock:
+            matcher = await file_call(ignore_matcher, root) if self.use_ignore_file else IgnoreMatcher()
+            index = await file_call(_scan_tree_sync, root, matcher)
+            if generation != self._generation:
+                return
+            self.root, self.matcher, self.index = root, matcher, index
+            backend = 'poll'
+            if WATCH_BACKEND != 'poll' and sys.platform.startswith('linux'):
+                try:
+                    self._inotify = _Inotify()
+                    await file_call(self._add_watches, [''] + [p for p, s in index.items() if s[0] == 'dir'])
+                    asyncio.get_running_loop().add_reader(self._inotify.fd, self._on_inotify)
+                    backend = 'inotify'
+                    # Catch anything that changed between the scan and the watches going in
+                    self._rescan = True
+                    self._schedule_flush()
+                except OSError as e:
+                    print(f"inotify unavailable ({e}); watching {root} by polling", file=sys.stderr)
+                    if self._inotify is not None:
+                        self._inotify.close()
+                        self._inotify = None
+            if backend == 'poll':
+                self._poll_task = asyncio.create_task(self._poll_loop(generation))
+            self.backend = backend
+
+    def _stop(self):
+        self._generation += 1
+        if self._inotify is not None:
+            try:
+                asyncio.get_running_loop().remove_reader(self._inotify.fd)
+            except Exception:
+                pass
+            self._inotify.close()
+            self._inotify = None
+        if self._poll_task is not None:
+            self._poll_task.cancel()
+            self._poll_task = None
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        self.backend = None
+        self.index = {}
+        self._dirty.clear()
+        self._rescan = False
+
+    def _add_watches(self, dirs):
+        for rel in dirs:
+            if rel not in self._inotify.watched:
+                self._inotify.add(self.root, rel)
+
+    def _on_inotify(self):
+        if self._inotify is None:
+            return
+        for rel, mask in self._inotify.read():
+            if rel is None or (rel == '' and mask & (_Inotify.IN_DELETE_SELF | _Inotify.IN_MOVE_SELF)):
+                self._rescan = True
+            elif rel == '.geminiignore':
+                self._rescan = True  # rules changed; rebuild the index under the new ones
+            elif rel:
+                self._dirty.add(rel)
+        if self._rescan or self._dirty:
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_handle is None:
+            self._flush_handle = asyncio.get_running_loop().call_later(WATCH_DEBOUNCE, self._start_flush)
+
+    def _start_flush(self):
+        self._flush_handle = None
+        asyncio.create_task(self._flush(self._generation))
+
+    async def _flush(self, generation: int):
+        async with self._lock:
+            if generation != self._generation:
+                return
+            if not self._live_subscribers():
+                self._stop()
+                return
+            if self._rescan:
+                self._rescan = False
+                self._dirty.clear()
+                matcher = await file_call(ignore_matcher, self.root) if self.use_ignore_file else IgnoreMatcher()
+                index = await file_call(_scan_tree_sync, self.root, matcher)
+                if generation != self._generation:
+                    return
+                events = self._apply_rescan(matcher, index)
+            else:
+                dirty, self._dirty = self._dirty, set()
+                known = {p for p, s in self.index.items() if s[0] == 'dir'}
+                updates = await file_call(_probe_paths_sync, self.root, self.matcher, dirty, known)
+                if generation != self._generation:
+                    return
+                events = self._apply_updates(updates)
+            if self._inotify is not None:
+                new_dirs = [p for p, s in self.index.items() if s[0] == 'dir' and p not in self._inotify.watched]
+                try:
+                    self._add_watches(new_dirs)
+                except OSError as e:
+                    # Most likely fs.inotify.max_user_watches; keep serving by polling instead
+                    print(f"inotify watch failed ({e}); switching to polling", file=sys.stderr)
+                    asyncio.get_running_loop().remove_reader(self._inotify.fd)
+                    self._inotify.close()
+                    self._inotify = None
+                    self.backend = 'poll'
+                    self._poll_task = asyncio.create_task(self._poll_loop(generation))
+            await self._publish(events)
+
+    async def _poll_loop(self, generation: int):
+        while generation == self._generation:
+            await asyncio.sleep(WATCH_POLL_INTERVAL)
+            self._rescan = True
+            await self._flush(generation)
+
+    @staticmethod
+    def _event(kind: str, rel: str, state: tuple) -> dict:
+        return {'event': kind, 'path': rel, 'kind': state[0], 'size': state[1],
+                'mtime': state[2] / 1e9}
+
+    def _apply_rescan(self, matcher: IgnoreMatcher, index: dict) -> list[dict]:
+        old = self.index
+        self.matcher, self.index = matcher, index
+        events = [self._event('file_deleted', p, s) for p, s in old.items() if p not in index]
+        for p, s in index.items():
+            before = old.get(p)
+            if before is None:
+                events.append(self._event('file_created', p, s))
+            elif before != s and s[0] != 'dir':
+                events.append(self._event('file_changed', p, s))
+        return events
+
+    def _apply_updates(self, updates: dict) -> list[dict]:
+        events = []
+        for rel, state in sorted(updates.items()):
+            before = self.index.get(rel)
+            if state is None:
+                if before is None:
+                    continue  # e.g. a temp file that came and went within the window
+                del self.index[rel]
+                events.append(self._event('file_deleted', rel, before))
+                if before[0] == 'dir':
+                    prefix = rel + '/'
+                    for child in [p for p in self.index if p.startswith(prefix)]:
+                        events.append(self._event('file_deleted', child, self.index.pop(child)))
+            elif before is None:
+                self.index[rel] = state
+                events.append(self._event('file_created', rel, state))
+            elif before != state:
+                self.index[rel] = state
+                # A directory's mtime moves with every entry added or removed in it
+                if state[0] != 'dir' or before[0] != 'dir':
+                    events.append(self._event('file_changed', rel, state))
+        return events
+
+    async def _publish(self, events: list[dict]):
+        if not events:
+            return
+        self.events_sent += len(events)
+        for start in range(0, len(events), WATCH_EVENTS_PER_FRAME):
+            message = json.dumps({'type': 'file_events', 'root': str(self.root),
+                                  'events': events[start:start + WATCH_EVENTS_PER_FRAME]})
+            for channel in self._live_subscribers():
+                await channel.send(message)
+
+    def stats(self) -> dict:
+        return {
+            'root': str(self.root) if self.backend else None,
+            'backend': self.backend,
+            'subscribers': len(self._live_subscribers()),
+            'entries': len(self.index),
+            'watches': len(self._inotify.watched) if self._inotify else 0,
+            'eventsSent': self.events_sent,
+        }
+
+
+workspace_watcher = WorkspaceWatcher()
+
+# Workspace content search
+# The walk is pruned with the compiled .geminiignore and handed out in batches to
+# a pool of search threads; file reads release the GIL, so reading and matching
+# overlap across workers. Each finished batch is sent to the client right away.
+SEARCH_WORKERS = int(os.getenv('SEARCH_WORKERS', min(8, os.cpu_count() or 2)))
+SEARCH_MAX_FILE_BYTES = int(os.getenv('SEARCH_MAX_FILE_BYTES', 4 * 1024 * 1024))
+SEARCH_MAX_RESULTS = 2000
+SEARCH_BATCH_FILES = 32
+SEARCH_PREVIEW_CHARS = 240
+_SEARCH_SKIP_DIRS = _ALWAYS_PRUNED_DIRS | {'.gemmit'}
+_search_executor = ThreadPoolExecutor(max_workers=SEARCH_WORKERS + 1, thread_name_prefix='search')  # +1 for the walk
+active_searches: dict[str, tuple[ClientChannel, asyncio.Task]] = {}  # searchId -> (requesting client, task)
+
+def _iter_search_files(work_dir: pathlib.Path, root: pathlib.Path, matcher: IgnoreMatcher):
+    """Yield workspace-relative paths of the non-ignored regular files below root."""
+    base = work_dir.resolve()
+    pending = [root]
+    while pending:
+        current = pending.pop()
+        try:
+            with os.scandir(current) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError:
+            continue
+        subdirs = []
+        for entry in entries:
+            try:
+                is_dir = entry.is_dir(follow_symlinks=False)
+                if not is_dir and not entry.is_file(follow_symlinks=False):
+                    continue
+            except OSError:
+                continue
+            rel = os.path.relpath(entry.path, base).replace(os.sep, '/')
+            if (is_dir and entry.name in _SEARCH_SKIP_DIRS) or matcher.ignored(rel, is_dir, entry.name):
+                continue
+            if is_dir:
+                subdirs.append(entry.path)
+            else:
+                yield rel
+        pending.extend(reversed(subdirs))
+
+def _next_batch(files, size: int) -> list[str]:
+    batch = []
+    for rel in files:
+        batch.append(rel)
+        if len(batch) >= size:
+            break
+    return batch
+
+def _search_file_sync(work_dir: pathlib.Path, rel: str, pattern: re.Pattern, limit: int) -> list[dict]:
+    try:
+        with open(work_dir / rel, 'rb') as f:
+            data = f.read(SEARCH_MAX_FILE_BYTES + 1)
+    except OSError:
+        return []
+    if len(data) > SEARCH_MAX_FILE_BYTES or b'\0' in data[:8192]:
+        return []  # too large, or binary
+    text = data.decode('utf-8', errors='replace')
+    if not pattern.search(text):
+        return []
+    matches = []
+    for line_no, line in enumerate(text.splitlines(), 1):
+        spans = [m.span() for m in pattern.finditer(line) if m.end() > m.start()]
+        if not spans:
+            continue
+        # Long (e.g. minified) lines are cut to a window around the first hit
+        start = max(0, spans[0][0] - SEARCH_PREVIEW_CHARS // 4)
+        matches.append({
+            'path': rel,
+            'line': line_no,
+            'spans': spans[:20],
+            'preview': line[start:start + SEARCH_PREVIEW_CHARS],
+            'previewStart': start,
+        })
+        if len(matches) >= limit:
+            break
+    return matches
+
+def _search_batch_sync(work_dir: pathlib.Path, batch: list[str], pattern: re.Pattern,
+                       limit: int, stop: threading.Event) -> tuple[list[dict], int]:
+    matches, scanned = [], 0
+    for rel in batch:
+        if stop.is_set() or len(matches) >= limit:
+            break
+        matches.extend(_search_file_sync(work_dir, rel, pattern, limit - len(matches)))
+        scanned += 1
+    return matches, scanned
+
+async def run_search(ws: ClientChannel, search_id: str, work_dir: pathlib.Path, root: pathlib.Path,
+                     pattern: re.Pattern, max_results: int):
+    """Stream search_results frames for one search, then a search_done summary."""
+    loop = asyncio.get_running_loop()
+    started = time.perf_counter()
+    stop = threading.Event()
+    found = scanned = 0
+    status = 'complete'
+    pending: set[asyncio.Future] = set()
+    try:
+        matcher = await file_call(ignore_matcher, work_dir)
+        files = _iter_search_files(work_dir, root, matcher)
+        exhausted = False
+        while True:
+            # Keep every worker busy, but never walk far ahead of the searching
+            while not exhausted and len(pending) < SEARCH_WORKERS:
+                batch = await loop.run_in_executor(_search_executor, _next_batch, files, SEARCH_BATCH_FILES)
+                if not batch:
+                    exhausted = True
+                    break
+                pending.add(loop.run_in_executor(
+                    _search_executor, _search_batch_sync, work_dir, batch, pattern, max_results - found, stop))
+            if not pending:
+                break
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for fut in done:
+                matches, count = fut.result()
+                scanned += count
+                matches = matches[:max_results - found]
+                if matches:
+                    found += len(matches)
+                    await ws.send(json.dumps({'type': 'search_results', 'searchId': search_id, 'matches': matches}))
+            if found >= max_results:
+                status = 'truncated'
+                break
+    except asyncio.CancelledError:
+        status = 'cancelled'
+    except Exception as e:
+        status = f'error: {e}'
+    finally:
+        stop.set()
+        for fut in pending:
+            fut.cancel()
+        if active_searches.get(search_id, (None, None))[1] is asyncio.current_task():
+            del active_searches[search_id]
+    await ws.send(json.dumps({
+        'type': 'search_done',
+        'searchId': search_id,
+        'status': status,
+        'matchCount': found,
+        'filesScanned': scanned,
+        'elapsedMs': round((time.perf_counter() - started) * 1000, 2),
+    }))
+
+# WebSocket handler and streaming utilities
+# Output is read in large chunks, decoded incrementally and coalesced: partial
+# lines are forwarded too, so text shows up before its newline arrives. After a
+# quiet period the first bytes are sent at once; while output keeps flowing, a
+# frame is sent when STREAM_FLUSH_BYTES are pending or STREAM_FLUSH_MS has
+# passed since the first pending byte, whichever comes first.
+STREAM_READ_SIZE = int(os.getenv('STREAM_READ_SIZE', 65536))
+STREAM_FLUSH_BYTES = int(os.getenv('STREAM_FLUSH_BYTES', 16384))
+STREAM_FLUSH_INTERVAL = float(os.getenv('STREAM_FLUSH_MS', 30)) / 1000
+
+# Live run streams: each prompt publishes its output into its conversation's
+# RunStream, a ring buffer of sequence-numbered frames that any number of clients
+# can follow. Runs queued behind each other share the stream, so seq only ever
+# increases for a conversation. A client that reconnects sends `subscribe` with
+# the next seq it needs and gets the missed frames replayed, then live output.
+# Once its last run has finished a stream stays available for RUN_STREAM_RETENTION seconds.
+RUN_STREAM_BUFFER_BYTES = int(os.getenv('RUN_STREAM_BUFFER_BYTES', 2 * 1024 * 1024))
+RUN_STREAM_RETENTION = float(os.getenv('RUN_STREAM_RETENTION', 300))
+
+
+class RunStream:
+    """Fan-out of one conversation's run frames with a bounded replay buffer."""
+
+    def __init__(self, conversation_id: str):
+        self.conversation_id = conversation_id
+        self.frames: deque[tuple[int, str | None, object, int]] = deque()  # (seq, stream or None, data or frame dict, size)
+        self.next_seq = 0
+        self.buffered_bytes = 0
+        self.subscribers: set[ClientChannel] = set()
+        self.runs = 0  # runs publishing here, running or queued
+        self.finished = False
+        self.expiry: asyncio.TimerHandle | None = None
+
+    @property
+    def first_seq(self) -> int:
+        return self.frames[0][0] if self.frames else self.next_seq
+
+    def _record(self, stream, payload, size: int) -> int:
+        seq = self.next_seq
+        self.next_seq += 1
+        self.frames.append((seq, stream, payload, size))
+        self.buffered_bytes += size
+        while self.buffered_bytes > RUN_STREAM_BUFFER_BYTES and len(self.frames) > 1:
+            self.buffered_bytes -= self.frames.popleft()[3]
+        return seq
+
+    def _live_subscribers(self):
+        self.subscribers = {c for c in self.subscribers if not c.closed}
+        return list(self.subscribers)
+
+    async def send_stream(self, stream: str, data: str):
+        if not data:
+            return
+        seq = self._record(stream, data, len(data))
+        for channel in self._live_subscribers():
+            await channel.send_stream(stream, data, conversationId=self.conversation_id, seq=seq)
+
+    async def send(self, message: str):
+        frame = json.loads(message)
+        frame['seq'] = self._record(None, frame, len(message))
+        message = json.dumps(frame)
+        for channel in self._live_subscribers():
+            await channel.send(message)
+
+    async def subscribe(self, channel: ClientChannel, from_seq: int = 0):
+        """Replay buffered frames from from_seq, then deliver live output to channel."""
+        truncated = from_seq < self.first_seq
+        await channel.send(json.dumps({
+            'type': 'subscribed',
+            'conversationId': self.conversation_id,
+            'running': not self.finished,
+            'firstSeq': self.first_seq,
+            'nextSeq': self.next_seq,
+            'truncated': truncated,
+        }))
+        # No awaits yield in here, so nothing can be published between replay and joining
+        for seq, stream, payload, _ in list(self.frames):
+            if seq < from_seq:
+                continue
+            if stream is None:
+                await channel.send(json.dumps({**payload, 'seq': seq}))
+            else:
+                await channel.send_stream(stream, payload, conversationId=self.conversation_id, seq=seq)
+        if not self.finished:
+            self.subscribers.add(channel)
+
+    def unsubscribe(self, channel: ClientChannel):
+        self.subscribers.discard(channel)
+
+    def stats(self) -> dict:
+        return {
+            'running': not self.finished,
+            'runs': self.runs,
+            'subscribers': len(self._live_subscribers()),
+            'firstSeq': self.first_seq,
+            'nextSeq': self.next_seq,
+            'bufferedBytes': self.buffered_bytes,
+        }
+
+
+run_streams: dict[str, RunStream] = {}
+
+def open_run_stream(conversation_id: str, origin: ClientChannel) -> RunStream:
+    """Attach a new run to the conversation's stream (kept, with its seq, if one is live or retained)."""
+    run = run_streams.get(conversation_id)
+    if run is None:
+        run = run_streams[conversation_id] = RunStream(conversation_id)
+    if run.expiry is not None:
+        run.expiry.cancel()
+        run.expiry = None
+    run.runs += 1
+    run.finished = False
+    run.subscribers.add(origin)
+    return run
+
+def finish_run_stream(run: RunStream):
+    run.runs -= 1
+    if run.runs > 0:
+        return  # a queued run of the same conversation still publishes here
+    run.finished = True
+
+    def _expire():
+        if run_streams.get(run.conversation_id) is run and run.finished:
+            del run_streams[run.conversation_id]
+    run.expiry = asyncio.get_running_loop().call_later(RUN_STREAM_RETENTION, _expire)
+
+async def stream_pipe(pipe, name, ws, buffer):
+    loop = asyncio.get_running_loop()
+    # Holds back an incomplete multi-byte sequence until the rest of it arrives
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    pending: list[str] = []
+    pending_size = 0
+    deadline = None
+    last_flush = float('-inf')
+
+    async def flush():
+        nonlocal pending_size, deadline, last_flush
+        data = ''.join(pending)
+        pending.clear()
+        pending_size = 0
+        deadline = None
+        last_flush = loop.time()
+        if name == 'stdout':
+            buffer.append(data)
+        await ws.send_stream(name, data)
+
+    try:
+        while True:
+            if pending:
+                try:
+                    chunk = await asyncio.wait_for(pipe.read(STREAM_READ_SIZE), max(0.0, deadline - loop.time()))
+                except asyncio.TimeoutError:
+                    await flush()
+                    continue
+            else:
+                chunk = await pipe.read(STREAM_READ_SIZE)
+            if not chunk:
+                break
+            text = decoder.decode(chunk)
+            if not text:
+                continue
+            now = loop.time()
+            if not pending:
+                deadline = now + STREAM_FLUSH_INTERVAL
+            pending.append(text)
+            pending_size += len(chunk)
+            if (pending_size >= STREAM_FLUSH_BYTES or now >= deadline
+                    or now - last_flush >= STREAM_FLUSH_INTERVAL):
+                await flush()
+        tail = decoder.decode(b'', final=True)
+        if tail:
+            pending.append(tail)
+        if pending:
+            await flush()
+    except asyncio.CancelledError:
+        # Stream was cancelled, this is expected
+        raise
+    except Exception as e:
+        # Handle other errors gracefully
+        print(f"Error in stream_pipe: {e}", file=sys.stderr)
+
+# In-process preview server
+# Serves WORK_DIR on the requested port from this process instead of spawning
+# `npx serve`: conditional requests and ranges come from aiohttp's FileResponse,
+# compressible files are gzip/brotli-encoded once per (file, mtime) and kept in
+# a size-bounded LRU. PREVIEW_SERVER=subprocess restores the npx/http.server chain.
+try:
+    import brotli  # optional; gzip is always available
+except ImportError:
+    brotli = None
+
+PREVIEW_SERVER = os.getenv('PREVIEW_SERVER', 'inprocess').lower()  # inprocess | subprocess
+PREVIEW_CACHE_BYTES = int(os.getenv('PREVIEW_CACHE_BYTES', 32 * 1024 * 1024))
+PREVIEW_COMPRESS_MIN_BYTES = 1024
+PREVIEW_COMPRESS_MAX_BYTES = 8 * 1024 * 1024
+_COMPRESSIBLE_TYPES = ('text/', 'application/javascript', 'application/json', 'application/xml',
+                       'application/manifest+json', 'image/svg+xml', 'application/wasm')
+
+def _compress_sync(path: pathlib.Path, encoding: str, inject: bool = False) -> bytes:
+    data = path.read_bytes()
+    if inject:
+        data = _inject_livereload(data)
+    if encoding == 'identity':
+        return data
+    if encoding == 'br':
+        return brotli.compress(data, quality=5)
+    return gzip.compress(data, compresslevel=6)
+
+def _preview_lookup_sync(root: pathlib.Path, rel: str):
+    """
+    Map a request path to (kind, path, stat). kind is 'file', 'index' (a directory's
+    index.html), 'dir' (a directory without one) or None; like serve, /page also
+    finds page.html. Dot paths (.git, .env, .gemmit, ...) are never served.
+    """
+    target = (root / rel).resolve()
+    if target != root and root not in target.parents:
+        return None, None, None
+    if any(part.startswith('.') for part in pathlib.PurePosixPath(rel).parts + target.relative_to(root).parts):
+        return None, None, None
+    is_dir = target.is_dir()
+    candidates = [target / 'index.html'] if is_dir else [target, target.with_name(target.name + '.html')]
+    for candidate in candidates:
+        try:
+            st = candidate.stat()
+        except OSError:
+            continue
+        if stat.S_ISREG(st.st_mode):
+            return ('index' if is_dir else 'file'), candidate, st
+    if is_dir:
+        return 'dir', target, None
+    return None, None, None
+
+def _listing_html(root: pathlib.Path, target: pathlib.Path) -> str:
+    rel = target.relative_to(root).as_posix()
+    title = html.escape('/' + (rel + '/' if rel != '.' else ''))
+    try:
+        names = sorted((e.name + '/' if e.is_dir() else e.name) for e in os.scandir(target) if not e.name.startswith('.'))
+    except OSError:
+        names = []
+    items = ''.join(f'<li><a href="{urllib.parse.quote(n)}">{html.escape(n)}</a></li>' for n in names)
+    return f'<!DOCTYPE html><html><head><meta charset="utf-8"><title>Index of {title}</title></head>' \
+           f'<body><h1>Index of {title}</h1><ul>{items}</ul></body></html>'
+
+
+# Live reload: HTML pages get a small client that opens a WebSocket back to the
+# preview server. A per-preview watcher (running only while a page is connected)
+# reports changes; only paths this preview has served (or 404'd) count, up to the
+# PREVIEW_RELOAD_PATHS most recently requested. CSS-only changes swap the
+# stylesheet in place, anything else reloads the page.
+PREVIEW_LIVE_RELOAD = os.getenv('PREVIEW_LIVE_RELOAD', '1').lower() not in ('0', 'false', 'no', 'off')
+PREVIEW_RELOAD_PATHS = int(os.getenv('PREVIEW_RELOAD_PATHS', 4096))
+_LIVERELOAD_PATH = '/__gemmit/livereload'
+_LIVERELOAD_TAG = f'<script src="{_LIVERELOAD_PATH}.js"></script>'.encode()
+_LIVERELOAD_JS = """(function () {
+  var url = (location.protocol === 'https:' ? 'wss://' : 'ws://') + location.host + '%s';
+  function connect() {
+    var ws = new WebSocket(url);
+    ws.onmessage = function (ev) {
+      var msg = JSON.parse(ev.data);
+      if (msg.type === 'css') {
+        var links = document.querySelectorAll('link[rel="stylesheet"]');
+        var swapped = 0;
+        links.forEach(function (link) {
+          var href = new URL(link.href, location.href);
+          if (href.host === location.host && msg.paths.indexOf(href.pathname) !== -1) {
+            href.searchParams.set('_lr', Date.now());
+            link.href = href.toString();
+            swapped++;
+          }
+        });
+        if (!swapped) location.reload();
+      } else if (msg.type === 'reload') {
+        location.reload();
+      }
+    };
+    ws.onclose = function () { setTimeout(connect, 1000); };
+  }
+  connect();
+})();
+""" % _LIVERELOAD_PATH
+
+def _inject_livereload(data: bytes) -> bytes:
+    at = data.lower().rfind(b'</body>')
+    if at == -1:
+        return data + _LIVERELOAD_TAG
+    return data[:at] + _LIVERELOAD_TAG + data[at:]
+
+
+class _ReloadSink:
+    """Watcher subscriber that hands file_events frames to a PreviewServer."""
+
+    def __init__(self, server: "PreviewServer"):
+        self.server = server
+        self.closed = False
+
+    async def send(self, message: str):
+        frame = json.loads(message)
+        if frame.get('type') == 'file_events':
+            await self.server._on_file_events(frame['events'])
+
+
+class _CompressedCache:
+    """LRU of encoded file bodies keyed on (path, mtime, size, encoding, injected), bounded by total size."""
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.entries: OrderedDict[tuple, bytes] = OrderedDict()
+        self.bytes = 0
+        self.hits = self.misses = 0
+
+    async def get(self, path: pathlib.Path, st: os.stat_result, encoding: str, inject: bool = False) -> bytes:
+        key = (str(path), st.st_mtime_ns, st.st_size, encoding, inject)
+        body = self.entries.get(key)
+        if body is not None:
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return body
+        self.misses += 1
+        body = await file_call(_compress_sync, path, encoding, inject)
+        if len(body) <= self.max_bytes // 4:
+            self.entries[key] = body
+            self.bytes += len(body)
+            while self.bytes > self.max_bytes:
+                _, old = self.entries.popitem(last=False)
+                self.bytes -= len(old)
+        return body
+
+    def stats(self) -> dict:
+        return {'entries': len(self.entries), 'bytes': self.bytes, 'hits': self.hits, 'misses': self.misses}
+
+
+preview_compression_cache = _CompressedCache(PREVIEW_CACHE_BYTES)
+
+
+class PreviewServer:
+    """A static file server for one directory on one port, running on this event loop."""
+
+    def __init__(self, root: pathlib.Path, port: int):
+        self.root = root.resolve()
+        self.port = port
+        self.requests = 0
+        self.started = time.time()
+        self.last_active = time.monotonic()
+        # Root-relative paths requested recently (LRU); live reload is scoped to these
+        self.served: OrderedDict[str, None] = OrderedDict()
+        self.reload_clients: set[web.WebSocketResponse] = set()
+        self.reloads = 0
+        self.watcher = WorkspaceWatcher(use_ignore_file=False)
+        self._sink = _ReloadSink(self)
+        app = web.Application(middlewares=[self._cors])
+        app.router.add_get(_LIVERELOAD_PATH, self._livereload)
+        app.router.add_get(_LIVERELOAD_PATH + '.js', self._livereload_js)
+        app.router.add_route('*', '/{tail:.*}', self._handle)
+        self.runner = web.AppRunner(app, access_log=None)
+
+    async def start(self):
+        await self.runner.setup()
+        try:
+            await web.TCPSite(self.runner, HOST, self.port).start()
+        except BaseException:
+            await self.runner.cleanup()
+            raise
+
+    async def stop(self):
+        self._sink.closed = True
+        self.watcher.unwatch(self._sink)
+        for ws in list(self.reload_clients):
+            await ws.close(code=1001, message=b'Preview stopped')
+        await self.runner.cleanup()
+
+    def touch(self):
+        self.last_active = time.monotonic()
+
+    def idle_seconds(self) -> float:
+        """Seconds since the last request; a page connected for live reload counts as active."""
+        if self.reload_clients:
+            return 0.0
+        return time.monotonic() - self.last_active
+
+    async def _livereload_js(self, request):
+        return web.Response(text=_LIVERELOAD_JS, content_type='application/javascript',
+                            headers={'Cache-Control': 'no-cache'})
+
+    async def _livereload(self, request):
+        ws = web.WebSocketResponse(heartbeat=30)
+        await ws.prepare(request)
+        self.reload_clients.add(ws)
+        try:
+            if len(self.reload_clients) == 1:
+                await self.watcher.watch(self._sink, self.root)
+            async for _ in ws:
+                pass
+        finally:
+            self.reload_clients.discard(ws)
+            self.touch()
+            if not self.reload_clients:
+                self.watcher.unwatch(self._sink)
+        return ws
+
+    async def _on_file_events(self, events: list[dict]):
+        hits = {e['path'] for e in events if e['path'] in self.served}
+        if not hits or not self.reload_clients:
+            return
+        if all(p.endswith('.css') for p in hits):
+            message = json.dumps({'type': 'css', 'paths': sorted('/' + p for p in hits)})
+        else:
+            message = json.dumps({'type': 'reload', 'paths': sorted('/' + p for p in hits)})
+        self.reloads += 1
+        for ws in list(self.reload_clients):
+            try:
+                await ws.send_str(message)
+            except Exception:
+                self.reload_clients.discard(ws)
+
+    @web.middleware
+    async def _cors(self, request, handler):
+        if request.method == 'OPTIONS':
+            response = web.Response(status=204)
+            response.headers['Access-Control-Allow-Methods'] = 'GET, HEAD, OPTIONS'
+            response.headers['Access-Control-Allow-Headers'] = request.headers.get('Access-Control-Request-Headers', '*')
+            response.headers['Access-Control-Max-Age'] = '600'
+        else:
+            response = await handler(request)
+        response.headers['Access-Control-Allow-Origin'] = '*'
+        return response
+
+    async def _handle(self, request: web.Request):
+        if request.method not in ('GET', 'HEAD'):
+            return web.Response(status=405, headers={'Allow': 'GET, HEAD, OPTIONS'})
+        self.requests += 1
+        self.touch()
+        rel = request.match_info['tail']
+        kind, path, st = await file_call(_preview_lookup_sync, self.root, rel)
+        if kind is None:
+            if rel and not rel.startswith('..'):
+                self._remember(rel.strip('/'))  # the page may be waiting for it to appear
+            return web.Response(status=404, text='Not Found')
+        if kind in ('index', 'dir') and rel and not request.path.endswith('/'):
+            # Relative links in an index page only resolve against a trailing slash
+            location = request.path + '/' + (f'?{request.query_string}' if request.query_string else '')
+            return web.Response(status=301, headers={'Location': location})
+        if kind == 'dir':
+            body = await file_call(_listing_html, self.root, path)
+            return web.Response(text=body, content_type='text/html', headers={'Cache-Control': 'no-cache'})
+
+        self._remember(path.relative_to(self.root).as_posix())
+        content_type = mimetypes.guess_type(path.name)[0] or 'application/octet-stream'
+        encoding = self._pick_encoding(request, content_type, st)
+        inject = PREVIEW_LIVE_RELOAD and content_type == 'text/html'
+        if encoding is None and not inject:
+            # Identity: ETag/Last-Modified/If-None-Match/Range handled by aiohttp
+            return web.FileResponse(path, headers={'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'})
+        etag = f'"{st.st_mtime_ns:x}-{st.st_size:x}-{encoding or "identity"}{"-lr" if inject else ""}"'
+        headers = {
+            'ETag': etag,
+            'Last-Modified': email.utils.formatdate(st.st_mtime, usegmt=True),
+            'Cache-Control': 'no-cache',
+            'Vary': 'Accept-Encoding',
+        }
+        if etag in request.headers.get('If-None-Match', ''):
+            return web.Response(status=304, headers=headers)
+        body = await preview_compression_cache.get(path, st, encoding or 'identity', inject)
+        if encoding:
+            headers['Content-Encoding'] = encoding
+        charset = 'utf-8' if content_type.startswith('text/') or content_type == 'application/javascript' else None
+        return web.Response(body=body, content_type=content_type, charset=charset, headers=headers)
+
+    def _remember(self, rel: str):
+        self.served[rel] = None
+        self.served.move_to_end(rel)
+        if len(self.served) > PREVIEW_RELOAD_PATHS:
+            self.served.popitem(last=False)
+
+    @staticmethod
+    def _pick_encoding(request: web.Request, content_type: str, st: os.stat_result) -> str | None:
+        if 'Range' in request.headers or not content_type.startswith(_COMPRESSIBLE_TYPES):
+            return None
+        if not PREVIEW_COMPRESS_MIN_BYTES <= st.st_size <= PREVIEW_COMPRESS_MAX_BYTES:
+            return None
+        accepted = {e.split(';')[0].strip() for e in request.headers.get('Accept-Encoding', '').split(',')}
+        if brotli is not None and 'br' in accepted:
+            return 'br'
+        return 'gzip' if 'gzip' in accepted else None
+
+    def stats(self) -> dict:
+        return {
+            'root': str(self.root),
+            'requests': self.requests,
+            'uptime': round(time.time() - self.started, 1),
+            'liveReloadClients': len(self.reload_clients),
+            'reloads': self.reloads,
+            'watchedPaths': len(self.served),
+            'idleSeconds': round(self.idle_seconds(), 1),
+        }
+
+async def _stop_frontend(entry):
+    """Stop a preview server or a frontend subprocess."""
+    if isinstance(entry, PreviewServer):
+        await entry.stop()
+        return
+    entry.terminate()
+    try:
+        await asyncio.wait_for(entry.wait(), timeout=5.0)
+    except asyncio.TimeoutError:
+        entry.kill()
+        await entry.wait()
+
+async def monitor_frontend_process(port: int, proc: asyncio.subprocess.Process):
+    """Monitor a frontend process and clean up when it exits"""
+    try:
+        await proc.wait()
+        print(f"Frontend server on port {port} exited with code {proc.returncode}", file=sys.stderr)
+        if proc.returncode != 0:
+            stdout, stderr = await proc.communicate()
+            print(f"Frontend server error output:", file=sys.stderr)
+            print(f"stdout: {stdout.decode()}", file=sys.stderr)
+            print(f"stderr: {stderr.decode()}", file=sys.stderr)
+    except Exception as e:
+        print(f"Error monitoring frontend process on port {port}: {e}", file=sys.stderr)
+    finally:
+        if frontend_processes.get(port) is proc:
+            frontend_processes.pop(port, None)
+
+async def stop_frontend_server(port: int):
+    """Stop a frontend server running on the specified port"""
+    if port in frontend_processes:
+        try:
+            print(f"Stopping frontend server on port {port}", file=sys.stderr)
+            await _stop_frontend(frontend_processes[port])
+            print(f"Frontend server on port {port} stopped", file=sys.stderr)
+            return True
+        except Exception as e:
+            print(f"Error stopping frontend server on port {port}: {e}", file=sys.stderr)
+            return False
+        finally:
+            frontend_processes.pop(port, None)
+    else:
+        print(f"No frontend server running on port {port}", file=sys.stderr)
+        return False
+
+async def start_frontend_server(port: int, work_dir: pathlib.Path) -> tuple[bool, list[dict]]:
+    """
+    Serve work_dir on port: in-process by default, or via npx serve & co. with
+    PREVIEW_SERVER=subprocess. Returns (success, attempts), one timing record per
+    server tried.
+    """
+    # Stop an existing server on this port if there is one
+    if port in frontend_processes:
+        try:
+            await _stop_frontend(frontend_processes[port])
+        except Exception as e:
+            print(f"Error stopping previous frontend server on port {port}: {e}", file=sys.stderr)
+        finally:
+            frontend_processes.pop(port, None)
+    if PREVIEW_SERVER == 'subprocess':
+        return await _start_subprocess_frontend(port, work_dir)
+    started = time.perf_counter()
+    server = PreviewServer(work_dir, port)
+    try:
+        await server.start()
+    except OSError as e:
+        print(f"Failed to start preview server on port {port}: {e}", file=sys.stderr)
+        return False, [_attempt_record('in-process', 'error', started, error=str(e))]
+    frontend_processes[port] = server
+    print(f"Started preview server on port {port} in {work_dir}")
+    return True, [_attempt_record('in-process', 'ready', started)]
+
+# Readiness of a spawned server is detected by connecting to its port, retrying
+# with exponential backoff; an early exit of the child ends the wait at once.
+PREVIEW_READY_TIMEOUT = float(os.getenv('PREVIEW_READY_TIMEOUT', 15))  # seconds; npx may download serve first
+PREVIEW_PROBE_INITIAL_DELAY = 0.01
+PREVIEW_PROBE_MAX_DELAY = 0.25
+
+def _attempt_record(command: str, outcome: str, started: float, **extra) -> dict:
+    return {'command': command, 'outcome': outcome, 'ms': round((time.perf_counter() - started) * 1000, 1), **extra}
+
+async def _port_accepts(port: int, timeout: float = 0.5) -> bool:
+    try:
+        _, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), timeout)
+    except (OSError, asyncio.TimeoutError):
+        return False
+    writer.close()
+    return True
+
+async def _wait_until_listening(port: int, proc: asyncio.subprocess.Process, timeout: float) -> str:
+    """'ready' once port accepts connections, 'exited' if proc dies first, else 'timeout'."""
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    delay = PREVIEW_PROBE_INITIAL_DELAY
+    exited = asyncio.ensure_future(proc.wait())
+    try:
+        while True:
+            if exited.done():
+                return 'exited'
+            if await _port_accepts(port):
+                return 'ready'
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                return 'timeout'
+            # Sleep, but wake up as soon as the child exits
+            await asyncio.wait([exited], timeout=min(delay, remaining))
+            delay = min(delay * 2, PREVIEW_PROBE_MAX_DELAY)
+    finally:
+        if not exited.done():
+            exited.cancel()
+
+async def _start_subprocess_frontend(port: int, work_dir: pathlib.Path) -> tuple[bool, list[dict]]:
+    """Start a frontend server using npx serve (or gemmit-npx in production)"""
+    attempts: list[dict] = []
+    try:
+        if await _port_accepts(port):
+            # Something else owns the port; every candidate would fail (or look ready when it is not)
+            print(f"Port {port} is already in use", file=sys.stderr)
+            return False, [{'command': None, 'outcome': 'port-in-use', 'ms': 0}]
         
         # Try gemmit-npx first (for production), fallback to npx (for development)
         # Use -C for CORS, -L to disable request logging for cleaner output
@@ -970,6 +3383,7 @@ async def start_frontend_server(port: int, work_dir: pathlib.Path):
         ]
         
         for cmd in commands_to_try:
+            started = time.perf_counter()
             try:
                 print(f"Attempting to start server with command: {' '.join(cmd)}", file=sys.stderr)
                 proc = await asyncio.create_subprocess_exec(
@@ -979,70 +3393,139 @@ async def start_frontend_server(port: int, work_dir: pathlib.Path):
                     env=os.environ
                 )
                 
-                # Wait a moment to see if the process starts successfully
-                await asyncio.sleep(1.0)
-                
-                # Check if process is still running
-                if proc.returncode is None:
-                    frontend_processes[port] = proc
-                    print(f"Started frontend server on port {port} in {work_dir} using {cmd[0]}")
-                    
-                    # Start a task to monitor the process
-                    asyncio.create_task(monitor_frontend_process(port, proc))
-                    
-                    # Wait a bit more and test if the server is actually responding
-                    await asyncio.sleep(1.0)
-                    
-                    # Try to connect to the server to verify it's working
-                    try:
-                        import aiohttp
-                        async with aiohttp.ClientSession() as session:
-                            # Test both root and a specific HTML file
-                            test_urls = [f'http://localhost:{port}', f'http://localhost:{port}/index.html']
-                            
-                            for test_url in test_urls:
-                                try:
-                                    async with session.get(test_url, timeout=aiohttp.ClientTimeout(total=3)) as response:
-                                        content_type = response.headers.get('content-type', 'unknown')
-                                        print(f"✅ {test_url} -> Status: {response.status}, Content-Type: {content_type}", file=sys.stderr)
-                                        
-                                        if response.status < 500:
-                                            # Read a bit of content to verify it's actually HTML
-                                            if test_url.endswith('.html') or test_url.endswith('/'):
-                                                content_preview = await response.text()
-                                                if content_preview.strip().startswith('<!DOCTYPE') or content_preview.strip().startswith('<html'):
-                                                    print(f"✅ HTML content verified for {test_url}", file=sys.stderr)
-                                                else:
-                                                    print(f"⚠️ Unexpected content for {test_url}: {content_preview[:100]}...", file=sys.stderr)
-                                except Exception as url_e:
-                                    print(f"⚠️ Could not test {test_url}: {url_e}", file=sys.stderr)
-                            
-                            return True
-                    except Exception as e:
-                        print(f"⚠️ Could not verify server on port {port}: {e}", file=sys.stderr)
-                        # Still return True since the process is running
-                        return True
-                else:
-                    # Process exited immediately, read error output
+                outcome = await _wait_until_listening(port, proc, PREVIEW_READY_TIMEOUT)
+                if outcome == 'exited':
+                    # Process exited before listening, read error output
                     stdout, stderr = await proc.communicate()
+                    attempts.append(_attempt_record(' '.join(cmd), outcome, started, exitCode=proc.returncode))
                     print(f"Command {cmd[0]} failed immediately:", file=sys.stderr)
                     print(f"stdout: {stdout.decode()}", file=sys.stderr)
                     print(f"stderr: {stderr.decode()}", file=sys.stderr)
                     continue
                 
+                # Still running: 'ready', or 'timeout' if it has not bound the port yet
+                # (e.g. npx still downloading); keep it either way, as before
+                attempts.append(_attempt_record(' '.join(cmd), outcome, started))
+                frontend_processes[port] = proc
+                print(f"Started frontend server on port {port} in {work_dir} using {cmd[0]} ({outcome} after {attempts[-1]['ms']} ms)")
+                asyncio.create_task(monitor_frontend_process(port, proc))
+                return True, attempts
+                
             except FileNotFoundError:
+                attempts.append(_attempt_record(' '.join(cmd), 'not-found', started))
                 print(f"Command {cmd[0]} not found, trying next option...")
                 continue
             except Exception as e:
+                attempts.append(_attempt_record(' '.join(cmd), 'error', started, error=str(e)))
                 print(f"Error starting {cmd[0]}: {e}", file=sys.stderr)
                 continue
         
         print("No suitable serve command found (tried gemmit-npx and npx)", file=sys.stderr)
-        return False
+        return False, attempts
         
     except Exception as e:
         print(f"Failed to start frontend server: {e}", file=sys.stderr)
-        return False
+        return False, attempts
+
+# Preview pool: ports come from PREVIEW_PORT_RANGE unless the client asks for a
+# free one, a directory that already has an in-process preview reuses it, at
+# most MAX_PREVIEW_SERVERS run at once (the least recently used in-process one
+# makes room), and in-process previews idle for PREVIEW_IDLE_MINUTES are stopped.
+def _parse_port_range(spec: str) -> range:
+    low, _, high = spec.partition('-')
+    return range(int(low), int(high or low) + 1)
+
+PREVIEW_PORT_RANGE = _parse_port_range(os.getenv('PREVIEW_PORT_RANGE', '5002-5099'))
+MAX_PREVIEW_SERVERS = int(os.getenv('MAX_PREVIEW_SERVERS', 4))
+PREVIEW_IDLE_MINUTES = float(os.getenv('PREVIEW_IDLE_MINUTES', 30))  # 0 disables reaping
+
+def _port_free(port: int) -> bool:
+    """True if nothing (in any process) is bound to port on HOST."""
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        if os.name == 'posix':
+            # Same as the listener will use, so sockets in TIME_WAIT do not count as taken
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        try:
+            sock.bind((HOST, port))
+        except OSError:
+            return False
+    return True
+
+def _allocate_preview_port(exclude=()) -> int | None:
+    for port in PREVIEW_PORT_RANGE:
+        if port not in frontend_processes and port not in exclude and _port_free(port):
+            return port
+    return None
+
+async def _make_room_for_preview() -> int | None:
+    """Stop the least recently used in-process preview if the pool is full; returns its port."""
+    if len(frontend_processes) < MAX_PREVIEW_SERVERS:
+        return None
+    candidates = [(server.last_active, port) for port, server in frontend_processes.items()
+                  if isinstance(server, PreviewServer)]
+    if not candidates:
+        return None
+    _, port = min(candidates)
+    print(f"Preview limit ({MAX_PREVIEW_SERVERS}) reached; stopping least recently used preview on port {port}", file=sys.stderr)
+    await stop_frontend_server(port)
+    return port
+
+async def open_preview(work_dir: pathlib.Path, requested_port: int | None = None) -> dict:
+    """
+    Serve work_dir, reusing a running preview of the same directory where possible.
+    requested_port is honoured when it is free or already ours (other than a preview
+    of a different directory, which is left running); otherwise a port is allocated
+    from PREVIEW_PORT_RANGE.
+    """
+    root = work_dir.resolve()
+    port = requested_port
+    occupant = frontend_processes.get(port)
+    if isinstance(occupant, PreviewServer) and occupant.root != root:
+        # It serves another directory (the UI always asks for the same port): leave it be
+        port = None
+    for existing, server in frontend_processes.items():
+        if isinstance(server, PreviewServer) and server.root == root and port in (None, existing):
+            server.touch()
+            return {'success': True, 'port': existing, 'reused': True, 'attempts': []}
+
+    evicted = None
+    if port not in frontend_processes:
+        # A new server is needed (an existing one on port would just be restarted)
+        evicted = await _make_room_for_preview()
+        if len(frontend_processes) >= MAX_PREVIEW_SERVERS:
+            return {'success': False, 'port': None, 'reused': False, 'attempts': [],
+                    'error': f'Too many preview servers running (limit {MAX_PREVIEW_SERVERS})'}
+    if port is None or (port not in frontend_processes and not _port_free(port)):
+        port = _allocate_preview_port()
+        if port is None:
+            return {'success': False, 'port': None, 'reused': False, 'attempts': [],
+                    'error': f'No free port in {PREVIEW_PORT_RANGE.start}-{PREVIEW_PORT_RANGE.stop - 1}'}
+    success, attempts = await start_frontend_server(port, work_dir)
+    if not success and port != requested_port:
+        # Lost a race for the allocated port; one more try with another
+        retry = _allocate_preview_port(exclude={port})
+        if retry is not None:
+            port = retry
+            success, more = await start_frontend_server(port, work_dir)
+            attempts += more
+    result = {'success': success, 'port': port, 'reused': False, 'attempts': attempts}
+    if requested_port is not None and port != requested_port:
+        result['requestedPort'] = requested_port
+    if evicted is not None:
+        result['evictedPort'] = evicted
+    return result
+
+async def reap_idle_previews():
+    """Stop in-process previews nobody has requested from (or watched) for PREVIEW_IDLE_MINUTES."""
+    if PREVIEW_IDLE_MINUTES <= 0:
+        return
+    idle_limit = PREVIEW_IDLE_MINUTES * 60
+    while True:
+        await asyncio.sleep(min(60.0, idle_limit / 4))
+        for port, server in list(frontend_processes.items()):
+            if isinstance(server, PreviewServer) and server.idle_seconds() > idle_limit:
+                print(f"Stopping preview on port {port} after {server.idle_seconds() / 60:.0f} idle minutes", file=sys.stderr)
+                await stop_frontend_server(port)
 
 async def cancel_process(conversation_id: str):
     """Cancel a running gemini process (equivalent to Ctrl+C)"""
@@ -1055,13 +3538,14 @@ async def cancel_process(conversation_id: str):
     # Cancel the asyncio task FIRST - this is more immediate
     if conversation_id in active_tasks:
         try:
-            task = active_tasks[conversation_id]
-            print(f"🛑 Cancelling task for conversation {conversation_id}", file=sys.stderr)
-            task.cancel()
+            tasks = list(active_tasks[conversation_id])
+            print(f"🛑 Cancelling {len(tasks)} task(s) for conversation {conversation_id}", file=sys.stderr)
+            for task in tasks:
+                task.cancel()
             
-            # Wait a very short time for the task to actually cancel
+            # Wait a very short time for the tasks to actually cancel
             try:
-                await asyncio.wait_for(asyncio.shield(task), timeout=0.1)
+                await asyncio.wait_for(asyncio.shield(asyncio.gather(*tasks, return_exceptions=True)), timeout=0.1)
             except (asyncio.CancelledError, asyncio.TimeoutError):
                 pass  # Expected when task is cancelled
             
@@ -1111,35 +3595,599 @@ async def cancel_process(conversation_id: str):
     
     return success
 
-async def run_gemini(prompt: str, work_dir: pathlib.Path, ws, conversation_id: str):
+def _gemini_command(prompt: str | None = None) -> list[str]:
     # Use chat endpoint, drop code-assist '-a'
-    cmd = [GEMINI_BIN, '-y', '-a', '-p', prompt, '-m', 'gemini-2.5-flash']
-    
-    # Create process in new process group for proper signal handling
+    cmd = [GEMINI_BIN, '-y', '-a']
+    if prompt is not None:
+        cmd += ['-p', prompt]
+    return cmd + ['-m', GEMINI_MODEL]
+
+def _prompt_tempfile(prompt: str):
+    """An anonymous temp file holding the prompt, on tmpfs where available, rewound for reading."""
+    shm = pathlib.Path('/dev/shm')
+    tmp_dir = str(shm) if shm.is_dir() and os.access(shm, os.W_OK) else None
+    f = tempfile.TemporaryFile(dir=tmp_dir)
+    f.write(prompt.encode('utf-8'))
+    f.seek(0)
+    return f
+
+async def _feed_stdin(proc: asyncio.subprocess.Process, data: bytes):
+    """Write the prompt to the child's stdin and close it so gemini sees EOF."""
+    try:
+        proc.stdin.write(data)
+        await proc.stdin.drain()
+    except (BrokenPipeError, ConnectionResetError) as e:
+        print(f"gemini closed stdin early: {e}", file=sys.stderr)
+    finally:
+        try:
+            proc.stdin.close()
+        except Exception:
+            pass
+
+def _gemini_env() -> dict:
     # Ensure MCP servers can access the full environment including embedded node runtime
     gemini_env = os.environ.copy()
     
     # Ensure critical environment variables are set for MCP server access
     if 'HOME' not in gemini_env:
         gemini_env['HOME'] = str(pathlib.Path.home())
-    
-    proc = await asyncio.create_subprocess_exec(
+    return gemini_env
+
+async def _spawn_gemini(cmd: list[str], work_dir: pathlib.Path, stdin) -> asyncio.subprocess.Process:
+    # Create process in new process group for proper signal handling
+    return await asyncio.create_subprocess_exec(
         *cmd, cwd=str(work_dir),
+        stdin=stdin,
         stdout=asyncio.subprocess.PIPE,
         stderr=asyncio.subprocess.PIPE,
-        env=gemini_env,
+        env=_gemini_env(),
         **_proc_group_kwargs(),
     )
+
+
+# Warm pool: gemini processes launched ahead of time and parked on stdin, so a
+# prompt skips Node/gemini-cli startup. Only used with GEMINI_PROMPT_MODE=stdin.
+# Off by default: a parked worker has already loaded GEMINI.md and the workspace
+# as they were when it started, so it is only replaced once a run has finished
+# with the workspace, and edits made outside runs are not seen until then.
+GEMINI_POOL_SIZE = int(os.getenv('GEMINI_POOL_SIZE', 0))
+GEMINI_POOL_MAX_IDLE = float(os.getenv('GEMINI_POOL_MAX_IDLE', 600))  # seconds
+
+
+class GeminiWorkerPool:
+    """Keeps up to `size` idle gemini processes per work dir and replenishes them in the background."""
+
+    def __init__(self, size: int, max_idle: float):
+        self.size = size
+        self.max_idle = max_idle
+        self.idle: dict[str, deque[tuple[asyncio.subprocess.Process, float]]] = {}
+        self._refills: dict[str, asyncio.Task] = {}
+        self.hits = 0
+        self.misses = 0
+
+    @property
+    def enabled(self) -> bool:
+        return self.size > 0
+
+    async def acquire(self, work_dir: pathlib.Path) -> asyncio.subprocess.Process:
+        """Hand out a parked worker for work_dir (or spawn one); call prime() once the run is over."""
+        parked = self.idle.get(str(work_dir))
+        proc = None
+        while parked:
+            candidate, since = parked.popleft()
+            if candidate.returncode is None and time.time() - since < self.max_idle:
+                proc = candidate
+                break
+            asyncio.create_task(self._discard(candidate))
+        if proc is not None:
+            self.hits += 1
+        else:
+            self.misses += 1
+            proc = await _spawn_gemini(_gemini_command(), work_dir, asyncio.subprocess.PIPE)
+        return proc
+
+    def prime(self, work_dir: pathlib.Path):
+        """Start filling the pool for work_dir unless a refill is already running."""
+        key = str(work_dir)
+        if not self.enabled or (key in self._refills and not self._refills[key].done()):
+            return
+        self._refills[key] = asyncio.create_task(self._refill(work_dir))
+
+    async def _refill(self, work_dir: pathlib.Path):
+        parked = self.idle.setdefault(str(work_dir), deque())
+        try:
+            while len(parked) < self.size:
+                proc = await _spawn_gemini(_gemini_command(), work_dir, asyncio.subprocess.PIPE)
+                parked.append((proc, time.time()))
+        except Exception as e:
+            print(f"Could not pre-launch gemini worker in {work_dir}: {e}", file=sys.stderr)
+
+    async def _discard(self, proc: asyncio.subprocess.Process):
+        if proc.returncode is not None:
+            return
+        try:
+            if os.name == 'posix':
+                os.killpg(os.getpgid(proc.pid), signal.SIGTERM)
+            else:
+                proc.terminate()
+            await asyncio.wait_for(proc.wait(), timeout=2.0)
+        except asyncio.TimeoutError:
+            proc.kill()
+            await proc.wait()
+        except Exception as e:
+            print(f"Error stopping idle gemini worker {proc.pid}: {e}", file=sys.stderr)
+
+    async def drain(self, keep: pathlib.Path | None = None):
+        """Stop idle workers for every work dir except `keep` (all of them when keep is None)."""
+        for key in list(self.idle):
+            if keep is not None and key == str(keep):
+                continue
+            task = self._refills.pop(key, None)
+            if task and not task.done():
+                task.cancel()
+            for proc, _ in self.idle.pop(key):
+                await self._discard(proc)
+
+    def stats(self) -> dict:
+        return {
+            'size': self.size,
+            'idle': {key: len(parked) for key, parked in self.idle.items()},
+            'hits': self.hits,
+            'misses': self.misses,
+        }
+
+
+gemini_pool = GeminiWorkerPool(GEMINI_POOL_SIZE if GEMINI_PROMPT_MODE == 'stdin' else 0, GEMINI_POOL_MAX_IDLE)
+
+# Persistent sessions: GEMINI_SESSION_MODE=acp keeps one `gemini --experimental-acp`
+# process per conversation (Agent Client Protocol, JSON-RPC over stdio), so later
+# turns send only the new user message and skip process startup entirely.
+GEMINI_SESSION_MODE = os.getenv('GEMINI_SESSION_MODE', '').lower()
+GEMINI_SESSION_TTL = float(os.getenv('GEMINI_SESSION_TTL', 900))  # seconds idle before reaping
+GEMINI_MAX_SESSIONS = int(os.getenv('GEMINI_MAX_SESSIONS', 4))
+
+
+class GeminiSession:
+    """One long-lived gemini ACP process with a single session, bound to a work dir."""
+
+    def __init__(self, work_dir: pathlib.Path):
+        self.work_dir = work_dir
+        self.proc: asyncio.subprocess.Process | None = None
+        self.session_id: str | None = None
+        self.last_used = time.time()
+        self.busy = False
+        self.turns_sent = 0
+        self._next_id = 0
+        self._pending: dict[int, asyncio.Future] = {}
+        self._on_chunk = None
+        self._reader: asyncio.Task | None = None
+        self._stderr_reader: asyncio.Task | None = None
+
+    @property
+    def alive(self) -> bool:
+        return self.proc is not None and self.proc.returncode is None
+
+    async def start(self):
+        cmd = [GEMINI_BIN, '--experimental-acp', '-y', '-m', GEMINI_MODEL]
+        self.proc = await asyncio.create_subprocess_exec(
+            *cmd, cwd=str(self.work_dir),
+            stdin=asyncio.subprocess.PIPE,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE,
+            env=_gemini_env(),
+            limit=16 * 1024 * 1024,  # a single JSON-RPC message can be large
+            **_proc_group_kwargs(),
+        )
+        self._reader = asyncio.create_task(self._read_messages())
+        self._stderr_reader = asyncio.create_task(self._read_stderr())
+        await self.request('initialize', {
+            'protocolVersion': 1,
+            'clientCapabilities': {'fs': {'readTextFile': False, 'writeTextFile': False}},
+        })
+        result = await self.request('session/new', {'cwd': str(self.work_dir), 'mcpServers': []})
+        self.session_id = result['sessionId']
+
+    async def _write(self, message: dict):
+        self.proc.stdin.write((json.dumps(message) + '\n').encode('utf-8'))
+        await self.proc.stdin.drain()
+
+    async def request(self, method: str, params: dict, timeout: float | None = 60.0):
+        self._next_id += 1
+        msg_id = self._next_id
+        fut = asyncio.get_running_loop().create_future()
+        self._pending[msg_id] = fut
+        try:
+            await self._write({'jsonrpc': '2.0', 'id': msg_id, 'method': method, 'params': params})
+            return await asyncio.wait_for(fut, timeout)
+        finally:
+            self._pending.pop(msg_id, None)
+
+    async def notify(self, method: str, params: dict):
+        await self._write({'jsonrpc': '2.0', 'method': method, 'params': params})
+
+    async def _read_messages(self):
+        try:
+            while True:
+                line = await self.proc.stdout.readline()
+                if not line:
+                    break
+                try:
+                    msg = json.loads(line)
+                except json.JSONDecodeError:
+                    continue  # stray non-protocol output
+                if 'method' in msg:
+                    await self._handle_agent_message(msg)
+                elif msg.get('id') in self._pending:
+                    fut = self._pending[msg['id']]
+                    if fut.done():
+                        continue
+                    if 'error' in msg:
+                        fut.set_exception(RuntimeError(msg['error'].get('message', 'ACP error')))
+                    else:
+                        fut.set_result(msg.get('result'))
+        except Exception as e:
+            print(f"Error reading gemini session output: {e}", file=sys.stderr)
+        finally:
+            for fut in self._pending.values():
+                if not fut.done():
+                    fut.set_exception(ConnectionError('gemini session exited'))
+
+    async def _read_stderr(self):
+        while True:
+            line = await self.proc.stderr.readline()
+            if not line:
+                break
+            if self._on_chunk is not None:
+                await self._on_chunk('stderr', line.decode('utf-8', errors='replace'))
+
+    async def _handle_agent_message(self, msg: dict):
+        method, params = msg['method'], msg.get('params') or {}
+        if method == 'session/update':
+            update = params.get('update') or {}
+            content = update.get('content') or {}
+            if update.get('sessionUpdate') == 'agent_message_chunk' and content.get('type') == 'text':
+                if self._on_chunk is not None:
+                    await self._on_chunk('stdout', content.get('text', ''))
+            return
+        if 'id' not in msg:
+            return
+        if method == 'session/request_permission':
+            # Same policy as `-y` for one-shot runs: allow
+            options = params.get('options') or []
+            allow = next((o for o in options if str(o.get('kind', '')).startswith('allow')), None)
+            outcome = {'outcome': 'selected', 'optionId': allow['optionId']} if allow else {'outcome': 'cancelled'}
+            await self._write({'jsonrpc': '2.0', 'id': msg['id'], 'result': {'outcome': outcome}})
+        else:
+            await self._write({'jsonrpc': '2.0', 'id': msg['id'],
+                               'error': {'code': -32601, 'message': f'Method not supported: {method}'}})
+
+    async def prompt(self, text: str, on_chunk) -> str:
+        """Send one user turn; streams chunks to on_chunk(stream, data) and returns the stop reason."""
+        self._on_chunk = on_chunk
+        self.busy = True
+        try:
+            result = await self.request('session/prompt', {
+                'sessionId': self.session_id,
+                'prompt': [{'type': 'text', 'text': text}],
+            }, timeout=None)
+            self.turns_sent += 1
+            return (result or {}).get('stopReason', 'end_turn')
+        except asyncio.CancelledError:
+            # Ask gemini to stop this turn but keep the session; kill it if it won't
+            try:
+                await self.notify('session/cancel', {'sessionId': self.session_id})
+            except Exception:
+                await self.close()
+            raise
+        finally:
+            self._on_chunk = None
+            self.busy = False
+            self.last_used = time.time()
+
+    async def close(self):
+        for task in (self._reader, self._stderr_reader):
+            if task and not task.done():
+                task.cancel()
+        if not self.alive:
+            return
+        try:
+            if os.name == 'posix':
+                os.killpg(os.getpgid(self.proc.pid), signal.SIGTERM)
+            else:
+                self.proc.terminate()
+            await asyncio.wait_for(self.proc.wait(), timeout=2.0)
+        except asyncio.TimeoutError:
+            self.proc.kill()
+            await self.proc.wait()
+        except Exception as e:
+            print(f"Error closing gemini session: {e}", file=sys.stderr)
+
+
+class GeminiSessionManager:
+    """Per-conversation GeminiSessions with an idle TTL and a cap on live sessions."""
+
+    def __init__(self, enabled: bool, ttl: float, max_sessions: int):
+        self.enabled = enabled
+        self.ttl = ttl
+        self.max_sessions = max(1, max_sessions)
+        self.sessions: dict[str, GeminiSession] = {}
+        self._starting: dict[str, asyncio.Future] = {}  # conversation -> done once its lookup/start is over
+        self._reaper: asyncio.Task | None = None
+
+    async def _session_for(self, conversation_id: str, work_dir: pathlib.Path) -> GeminiSession | None:
+        # One lookup/start per conversation at a time, so two first turns can't both launch a process
+        while (pending := self._starting.get(conversation_id)) is not None:
+            await asyncio.shield(pending)
+        done = self._starting[conversation_id] = asyncio.get_running_loop().create_future()
+        try:
+            return await self._get_or_start(conversation_id, work_dir)
+        finally:
+            del self._starting[conversation_id]
+            done.set_result(None)
+
+    async def _get_or_start(self, conversation_id: str, work_dir: pathlib.Path) -> GeminiSession | None:
+        session = self.sessions.get(conversation_id)
+        if session is not None and (not session.alive or session.work_dir != work_dir):
+            await self.sessions.pop(conversation_id).close()
+            session = None
+        if session is not None:
+            return session
+        if len(self.sessions) >= self.max_sessions:
+            idle = [(s.last_used, cid) for cid, s in self.sessions.items() if not s.busy]
+            if not idle:
+                return None  # every slot is mid-turn; caller falls back to a one-shot process
+            await self.sessions.pop(min(idle)[1]).close()
+        session = GeminiSession(work_dir)
+        try:
+            await session.start()
+        except Exception as e:
+            print(f"Could not start gemini session for {conversation_id}: {e}", file=sys.stderr)
+            await session.close()
+            return None
+        self.sessions[conversation_id] = session
+        if self._reaper is None or self._reaper.done():
+            self._reaper = asyncio.create_task(self._reap())
+        return session
+
+    async def run(self, conversation_id: str, work_dir: pathlib.Path, full_prompt: str, user_turn: str, ws):
+        """Run one turn in the conversation's session; None means no session was available."""
+        session = await self._session_for(conversation_id, work_dir)
+        if session is None or session.busy:
+            return None
+        out_buf: list[str] = []
+
+        async def on_chunk(stream, data):
+            if stream == 'stdout':
+                out_buf.append(data)
+            try:
+                await ws.send_stream(stream, data)
+            except Exception:
+                pass  # WS may be closed
+
+        # A fresh session has never seen this conversation, so it gets the history once
+        text = full_prompt if session.turns_sent == 0 else user_turn
+        try:
+            stop_reason = await session.prompt(text, on_chunk)
+        except (ConnectionError, RuntimeError) as e:
+            print(f"gemini session for {conversation_id} failed: {e}", file=sys.stderr)
+            await self.sessions.pop(conversation_id, session).close()
+            return -1, ''.join(out_buf)
+        return (0 if stop_reason != 'cancelled' else -1), ''.join(out_buf)
+
+    async def _reap(self):
+        while self.sessions:
+            await asyncio.sleep(min(30.0, self.ttl))
+            now = time.time()
+            for cid, session in list(self.sessions.items()):
+                if not session.busy and (now - session.last_used > self.ttl or not session.alive):
+                    print(f"Reaping idle gemini session for {cid}", file=sys.stderr)
+                    await self.sessions.pop(cid).close()
+
+    async def discard(self, conversation_id: str):
+        session = self.sessions.pop(conversation_id, None)
+        if session is not None:
+            await session.close()
+
+    async def close_all(self):
+        for cid in list(self.sessions):
+            await self.sessions.pop(cid).close()
+
+    def stats(self) -> dict:
+        return {
+            'enabled': self.enabled,
+            'max': self.max_sessions,
+            'sessions': {cid: {'busy': s.busy, 'idleSeconds': round(time.time() - s.last_used, 1)}
+                         for cid, s in self.sessions.items()},
+        }
+
+
+gemini_sessions = GeminiSessionManager(GEMINI_SESSION_MODE == 'acp', GEMINI_SESSION_TTL, GEMINI_MAX_SESSIONS)
+
+# Response cache (opt-in, RESPONSE_CACHE=1): replays the output of an earlier run
+# when the prompt (which includes the history window), the model, the work dir
+# and its state are all unchanged. Only runs that left the work dir untouched
+# are stored, since replaying output can't redo gemini's file edits.
+RESPONSE_CACHE = os.getenv('RESPONSE_CACHE', '').lower() in ('1', 'true', 'yes', 'on')
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', 32 * 1024 * 1024))
+RESPONSE_CACHE_TTL = float(os.getenv('RESPONSE_CACHE_TTL', 3600))
+FINGERPRINT_MAX_FILES = int(os.getenv('FINGERPRINT_MAX_FILES', 20000))
+_FINGERPRINT_SKIP_DIRS = {'.git', 'node_modules', '.gemmit', '__pycache__'}
+
+def workdir_fingerprint(work_dir: pathlib.Path) -> str | None:
+    """Hash of every file's path, size and mtime under work_dir; None if the tree is too large to fingerprint."""
+    digest = hashlib.sha256()
+    count = 0
+    stack = [work_dir]
+    while stack:
+        current = stack.pop()
+        try:
+            with os.scandir(current) as it:
+                entries = sorted(it, key=lambda e: e.name)
+        except OSError:
+            continue
+        for entry in entries:
+            try:
+                if entry.is_dir(follow_symlinks=False):
+                    if entry.name not in _FINGERPRINT_SKIP_DIRS:
+                        stack.append(pathlib.Path(entry.path))
+                    continue
+                st = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            count += 1
+            if count > FINGERPRINT_MAX_FILES:
+                return None
+            rel = os.path.relpath(entry.path, work_dir)
+            digest.update(f"{rel}\0{st.st_size}\0{st.st_mtime_ns}\n".encode('utf-8', 'surrogateescape'))
+    return digest.hexdigest()
+
+
+class ResponseCache:
+    """Content-addressed LRU of run outputs, bounded by total size and entry age."""
+
+    def __init__(self, enabled: bool, max_bytes: int, ttl: float):
+        self.enabled = enabled
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.entries: OrderedDict[str, tuple[float, list[tuple[str, str]], str, int]] = OrderedDict()
+        self.bytes = 0
+        self.hits = self.misses = self.stores = self.uncacheable = self.evictions = 0
+
+    @staticmethod
+    def key(prompt: str, model: str, work_dir: pathlib.Path, fingerprint: str) -> str:
+        # The fingerprint only covers relative paths: two identical trees must not share entries
+        return hashlib.sha256('\0'.join((model, str(work_dir), fingerprint, prompt)).encode('utf-8')).hexdigest()
+
+    def get(self, key: str):
+        entry = self.entries.get(key)
+        if entry is not None and time.time() - entry[0] > self.ttl:
+            self._evict(key)
+            entry = None
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1], entry[2]
+
+    def put(self, key: str, frames: list[tuple[str, str]], reply: str):
+        size = sum(len(d) for _, d in frames) + len(reply)
+        if size > self.max_bytes // 4:
+            self.uncacheable += 1
+            return
+        if key in self.entries:
+            self._evict(key)
+        self.entries[key] = (time.time(), frames, reply, size)
+        self.bytes += size
+        self.stores += 1
+        while self.bytes > self.max_bytes and self.entries:
+            self._evict(next(iter(self.entries)))
+
+    def _evict(self, key: str):
+        _, _, _, size = self.entries.pop(key)
+        self.bytes -= size
+        self.evictions += 1
+
+    def stats(self) -> dict:
+        return {
+            'enabled': self.enabled,
+            'entries': len(self.entries),
+            'bytes': self.bytes,
+            'hits': self.hits,
+            'misses': self.misses,
+            'stores': self.stores,
+            'uncacheable': self.uncacheable,
+            'evictions': self.evictions,
+        }
+
+
+response_cache = ResponseCache(RESPONSE_CACHE, RESPONSE_CACHE_MAX_BYTES, RESPONSE_CACHE_TTL)
+
+
+class _RecordingSink:
+    """Forwards stream frames to a sink while keeping a copy of them."""
+
+    def __init__(self, sink):
+        self.sink = sink
+        self.frames: list[tuple[str, str]] = []
+
+    async def send_stream(self, stream: str, data: str):
+        self.frames.append((stream, data))
+        await self.sink.send_stream(stream, data)
+
+    async def send(self, message: str):
+        await self.sink.send(message)
+
+
+async def run_gemini(prompt: str, work_dir: pathlib.Path, ws, conversation_id: str, user_turn: str | None = None):
+    if not response_cache.enabled:
+        return await _run_gemini_uncached(prompt, work_dir, ws, conversation_id, user_turn)
+
+    fingerprint = await asyncio.to_thread(workdir_fingerprint, work_dir)
+    key = response_cache.key(prompt, GEMINI_MODEL, work_dir.resolve(), fingerprint) if fingerprint else None
+    cached = response_cache.get(key) if key else None
+    if cached is not None:
+        frames, reply = cached
+        print(f"Response cache hit for conversation {conversation_id}", file=sys.stderr)
+        # A live session never saw this turn; start it over with the full history next time
+        await gemini_sessions.discard(conversation_id)
+        for stream, data in frames:
+            await ws.send_stream(stream, data)
+        return 0, reply
+
+    recorder = _RecordingSink(ws)
+    rc, reply = await _run_gemini_uncached(prompt, work_dir, recorder, conversation_id, user_turn)
+    if rc == 0 and key:
+        after = await asyncio.to_thread(workdir_fingerprint, work_dir)
+        if after == fingerprint:
+            response_cache.put(key, recorder.frames, reply)
+        else:
+            response_cache.uncacheable += 1
+    return rc, reply
+
+async def _run_gemini_uncached(prompt: str, work_dir: pathlib.Path, ws, conversation_id: str, user_turn: str | None = None):
+    if gemini_sessions.enabled and user_turn is not None:
+        try:
+            result = await gemini_sessions.run(conversation_id, work_dir, prompt, user_turn, ws)
+        except asyncio.CancelledError:
+            try:
+                await ws.send_stream('stderr', '\n[Process cancelled by user]\n')
+            except Exception:
+                pass  # WS may be closed
+            return -1, '[Process cancelled by user]'
+        if result is not None:
+            return result
+        # No session available: fall back to a one-shot process
+
+    mode = GEMINI_PROMPT_MODE if GEMINI_PROMPT_MODE in ('stdin', 'file', 'argv') else 'stdin'
+    cmd = _gemini_command(prompt if mode == 'argv' else None)
+    
+    pooled = mode == 'stdin' and gemini_pool.enabled
+    if pooled:
+        proc = await gemini_pool.acquire(work_dir)
+    else:
+        prompt_file = _prompt_tempfile(prompt) if mode == 'file' else None
+        try:
+            proc = await _spawn_gemini(
+                cmd, work_dir,
+                asyncio.subprocess.PIPE if mode == 'stdin' else (prompt_file or asyncio.subprocess.DEVNULL))
+        finally:
+            # The child holds its own descriptor; ours (and the file) can go now
+            if prompt_file is not None:
+                prompt_file.close()
     
     # Track the process for cancellation
     active_processes[conversation_id] = proc
     
     try:
         out_buf: list[str] = []
-        await asyncio.gather(
+        pipes = [
             stream_pipe(proc.stdout, 'stdout', ws, out_buf),
             stream_pipe(proc.stderr, 'stderr', ws, [])
-        )
+        ]
+        if mode == 'stdin':
+            pipes.append(_feed_stdin(proc, prompt.encode('utf-8')))
+        await asyncio.gather(*pipes)
         await proc.wait()
         return proc.returncode, ''.join(out_buf)
     except asyncio.CancelledError:
@@ -1168,36 +4216,122 @@ async def run_gemini(prompt: str, work_dir: pathlib.Path, ws, conversation_id: s
             print(f"Error during cancellation: {e}", file=sys.stderr)
 
         try:
-            await ws.send(json.dumps({'type': 'stream', 'stream': 'stderr', 'data': '\n[Process cancelled by user]\n'}))
+            await ws.send_stream('stderr', '\n[Process cancelled by user]\n')
         except Exception:
             pass  # WS may be closed
         return -1, '[Process cancelled by user]'
     finally:
         # Clean up process tracking
         active_processes.pop(conversation_id, None)
+        if pooled:
+            # Only now, so the replacement worker loads the workspace as this run left it
+            gemini_pool.prime(work_dir)
 
-async def ws_handler(ws, path=None):
-    async for msg in ws:
+async def ws_handler(websocket, path=None):
+    ws = ClientChannel(websocket)
+    try:
+        await _serve_client(websocket, ws)
+    finally:
+        workspace_watcher.unwatch(ws)
+        for owner, task in list(active_searches.values()):
+            if owner is ws:
+                task.cancel()
+        ws.close()
+
+async def _serve_client(websocket, ws: ClientChannel):
+    async for msg in websocket:
         data = json.loads(msg)
         # File operations
         typ = data.get('type')
         if typ == 'list_files':
-            files = [f.name for f in WORK_DIR.iterdir() if f.is_file()]
+            files = await file_call(_list_files_sync, WORK_DIR)
             await ws.send(json.dumps({'type': 'file_list', 'files': files}))
             continue
         if typ == 'get_file':
             fn = WORK_DIR / data['filename']
             try:
-                content = fn.read_text()
+                content = await file_call(_read_file_sync, fn)
                 err = ''
             except Exception as e:
                 content, err = '', str(e)
             await ws.send(json.dumps({'type': 'file_content', 'filename': fn.name, 'content': content, 'error': err}))
             continue
+        if typ == 'search_files':
+            # Grep the workspace; results stream back as search_results frames
+            search_id = str(data.get('searchId') or uuid.uuid4())
+            query = data.get('query') or ''
+            try:
+                if not query:
+                    raise ValueError('Missing "query"')
+                flags = 0 if data.get('caseSensitive') else re.IGNORECASE
+                pattern = re.compile(query if data.get('regex') else re.escape(query), flags)
+                root = _resolve_in_workdir(data['path']) if data.get('path') else WORK_DIR
+                max_results = max(1, min(int(data.get('maxResults', SEARCH_MAX_RESULTS)), SEARCH_MAX_RESULTS))
+            except (re.error, ValueError, PermissionError) as e:
+                await ws.send(json.dumps({'type': 'search_done', 'searchId': search_id, 'status': f'error: {e}',
+                                          'matchCount': 0, 'filesScanned': 0, 'elapsedMs': 0}))
+                continue
+            if search_id in active_searches:
+                active_searches[search_id][1].cancel()
+            await ws.send(json.dumps({'type': 'search_started', 'searchId': search_id, 'query': query}))
+            active_searches[search_id] = (ws, asyncio.create_task(
+                run_search(ws, search_id, WORK_DIR, root, pattern, max_results)))
+            continue
+        if typ == 'list_tree':
+            # Recursive, paginated, .geminiignore-aware listing
+            started = time.perf_counter()
+            reply = {'type': 'file_tree', 'path': data.get('path', ''), 'cursor': data.get('cursor')}
+            try:
+                limit = max(1, min(int(data.get('limit', TREE_PAGE_DEFAULT)), TREE_PAGE_MAX))
+                max_depth = int(data['maxDepth']) if data.get('maxDepth') is not None else None
+                page = await file_call(_list_tree_sync, WORK_DIR, data.get('path', ''), data.get('cursor'), limit, max_depth)
+                reply.update(page, error='')
+            except Exception as e:
+                reply.update(entries=[], nextCursor=None, error=str(e))
+            reply['elapsedMs'] = round((time.perf_counter() - started) * 1000, 2)
+            await ws.send(json.dumps(reply))
+            continue
+        if typ == 'read_file_chunk':
+            # Byte-range read of any file (binary included), base64 encoded
+            name = data.get('filename', '')
+            offset = max(0, int(data.get('offset', 0)))
+            length = max(0, min(int(data.get('length', MAX_FILE_CHUNK_BYTES)), MAX_FILE_CHUNK_BYTES))
+            reply = {'type': 'file_chunk', 'filename': name, 'offset': offset}
+            try:
+                chunk, size = await file_call(_read_chunk_sync, _resolve_in_workdir(name), offset, length)
+                reply.update(size=size, length=len(chunk), eof=offset + len(chunk) >= size,
+                             data=base64.b64encode(chunk).decode('ascii'), error='')
+            except Exception as e:
+                reply.update(size=0, length=0, eof=True, data='', error=str(e))
+            await ws.send(json.dumps(reply))
+            continue
+        if typ == 'write_file_chunk':
+            # Resumable upload: chunks land in a hidden partial file, `final` moves it into place
+            name = data.get('filename', '')
+            reply = {'type': 'write_chunk_ack', 'filename': name}
+            try:
+                target = _resolve_in_workdir(name)
+                partial = _upload_path(target)
+                offset = max(0, int(data.get('offset', 0)))
+                chunk = base64.b64decode(data.get('data', ''))
+                current = await file_call(_upload_offset, partial)
+                if offset > current:
+                    raise ValueError(f"Offset {offset} beyond received data ({current} bytes)")
+                if offset + len(chunk) > MAX_UPLOAD_BYTES:
+                    raise ValueError(f"Upload exceeds {MAX_UPLOAD_BYTES} bytes")
+                new_offset = await file_call(_append_upload_sync, partial, offset, chunk)
+                complete = bool(data.get('final'))
+                if complete:
+                    await file_call(os.replace, partial, target)
+                reply.update(offset=new_offset, complete=complete, error='')
+            except Exception as e:
+                reply.update(offset=None, complete=False, error=str(e))
+            await ws.send(json.dumps(reply))
+            continue
         if typ == 'save_file':
             fn = WORK_DIR / data['filename']
             try:
-                fn.write_text(data['content'])
+                await file_call(_atomic_write_sync, fn, data['content'])
                 err = ''
             except Exception as e:
                 err = str(e)
@@ -1207,13 +4341,18 @@ async def ws_handler(ws, path=None):
         # Handle frontend server commands
         command = data.get('command')
         if command == 'start-frontend':
-            port = int(data.get('port', 5002))
-            success = await start_frontend_server(port, WORK_DIR)
+            # No port (or 0/"auto") picks a free one from PREVIEW_PORT_RANGE
+            raw_port = str(data.get('port') or '').strip()
+            port = int(raw_port) if raw_port.isdigit() and int(raw_port) > 0 else None
+            result = await open_preview(WORK_DIR, port)
+            if result['success']:
+                message = f"Frontend server {'already running' if result['reused'] else 'started'} on port {result['port']}"
+            else:
+                message = f"Frontend server failed to start: {result.get('error') or 'no server could be started'}"
             await ws.send(json.dumps({
                 'type': 'frontend_result', 
-                'success': success, 
-                'port': port,
-                'message': f"Frontend server {'started' if success else 'failed to start'} on port {port}"
+                'message': message,
+                **result
             }))
             continue
         if command == 'change-workdir':
@@ -1234,11 +4373,15 @@ async def ws_handler(ws, path=None):
             has_active = bool(active_tasks or active_processes)
 
             try:
-                info = change_work_dir_sync(
+                info = await change_work_dir(
                     path_str,
                     relative_to_current=relative_to_current,
                     also_update_output_dir=also_update_output_dir
                 )
+                # Parked workers are bound to the old directory
+                asyncio.create_task(gemini_pool.drain(keep=WORK_DIR))
+                gemini_pool.prime(WORK_DIR)
+                await workspace_watcher.reroot(WORK_DIR)
                 await ws.send(json.dumps({
                     'type': 'workdir_result',
                     'success': True,
@@ -1265,6 +4408,17 @@ async def ws_handler(ws, path=None):
             continue
         
         # Handle process cancellation
+        if command == 'cancel' and data.get('searchId'):
+            _, task = active_searches.get(data['searchId'], (None, None))
+            if task is not None:
+                task.cancel()
+            await ws.send(json.dumps({
+                'type': 'cancel_result',
+                'success': True,
+                'searchId': data['searchId'],
+                'message': 'Search cancelled' if task is not None else 'Search already completed or not found'
+            }))
+            continue
         if command == 'cancel':
             cid = data.get('conversationId')
             if cid:
@@ -1294,45 +4448,100 @@ async def ws_handler(ws, path=None):
                 'type': 'status_info',
                 'active_processes': list(active_processes.keys()),
                 'active_tasks': list(active_tasks.keys()),
-                'frontend_processes': list(frontend_processes.keys())
+                'frontend_processes': list(frontend_processes.keys()),
+                'preview_servers': {port: server.stats() for port, server in frontend_processes.items()
+                                    if isinstance(server, PreviewServer)},
+                'preview_compression_cache': preview_compression_cache.stats(),
+                'static_assets': static_assets.stats(),
+                'active_searches': list(active_searches.keys()),
+                'gemini_pool': gemini_pool.stats(),
+                'gemini_sessions': gemini_sessions.stats(),
+                'run_queue': run_scheduler.stats(),
+                'send_queues': send_queue_stats(),
+                'run_streams': {cid: run.stats() for cid, run in run_streams.items()},
+                'response_cache': response_cache.stats(),
+                'workspace_watcher': workspace_watcher.stats()
             }))
             continue
         
         # Handle conversation list request
         if command == 'list-conversations':
-            conversation_list = []
-            for cid, messages in conversations.items():
-                if messages:  # Only include conversations with messages
-                    # Get the first user message as preview
-                    first_message = messages[0] if messages else ""
-                    preview = first_message.replace("User: ", "").strip()[:100]
-                    if len(preview) > 100:
-                        preview += "..."
-                    
-                    conversation_list.append({
-                        'id': cid,
-                        'preview': preview,
-                        'messageCount': len(messages),
-                        'lastModified': time.time()  # We don't track this yet, so use current time
-                    })
-            
-            # Sort by message count (most recent activity first)
-            conversation_list.sort(key=lambda x: x['messageCount'], reverse=True)
+            offset = max(0, int(data.get('offset', 0)))
+            limit = int(data['limit']) if data.get('limit') is not None else None
+            entries, total = await store_call(conversations.list_entries, offset, limit)
+            conversation_list = [{
+                'id': e['id'],
+                'preview': e.get('preview', ''),
+                'messageCount': e.get('messageCount', 0),
+                'lastModified': e.get('updated', 0)
+            } for e in entries]
             
             await ws.send(json.dumps({
                 'type': 'conversation_list',
-                'conversations': conversation_list
+                'conversations': conversation_list,
+                'total': total,
+                'offset': offset
+            }))
+            continue
+        
+        # Follow a conversation's live output, replaying anything after fromSeq
+        if command == 'subscribe':
+            target_cid = data.get('conversationId')
+            run = run_streams.get(target_cid)
+            if run is None:
+                await ws.send(json.dumps({
+                    'type': 'subscribed',
+                    'conversationId': target_cid,
+                    'running': False,
+                    'error': 'No live or recent output for this conversation'
+                }))
+            else:
+                await run.subscribe(ws, max(0, int(data.get('fromSeq', 0))))
+            continue
+        if command == 'unsubscribe':
+            run = run_streams.get(data.get('conversationId'))
+            if run is not None:
+                run.unsubscribe(ws)
+            await ws.send(json.dumps({'type': 'unsubscribed', 'conversationId': data.get('conversationId')}))
+            continue
+        
+        # Push file_events for changes under WORK_DIR until unwatch or disconnect
+        if command == 'watch':
+            try:
+                info = await workspace_watcher.watch(ws, WORK_DIR)
+                await ws.send(json.dumps({'type': 'watch_result', 'watching': True, **info}))
+            except Exception as e:
+                workspace_watcher.unwatch(ws)
+                await ws.send(json.dumps({'type': 'watch_result', 'watching': False, 'error': str(e)}))
+            continue
+        if command == 'unwatch':
+            workspace_watcher.unwatch(ws)
+            await ws.send(json.dumps({'type': 'watch_result', 'watching': False}))
+            continue
+        
+        # Handle conversation search request
+        if command == 'search-conversations':
+            query = (data.get('query') or '').strip()
+            limit = max(1, min(int(data.get('limit', 20)), 200))
+            started = time.perf_counter()
+            results = await store_call(conversations.search, query, limit) if query else []
+            await ws.send(json.dumps({
+                'type': 'conversation_search_results',
+                'query': query,
+                'results': results,
+                'elapsedMs': round((time.perf_counter() - started) * 1000, 2)
             }))
             continue
         
         # Handle conversation load request
         if command == 'load-conversation':
             target_cid = data.get('conversationId')
-            if target_cid and target_cid in conversations:
+            messages = await store_call(conversations.get, target_cid) if target_cid else None
+            if messages is not None:
                 await ws.send(json.dumps({
                     'type': 'conversation_loaded',
                     'conversationId': target_cid,
-                    'messages': conversations[target_cid]
+                    'messages': messages
                 }))
             else:
                 await ws.send(json.dumps({
@@ -1352,43 +4561,64 @@ async def ws_handler(ws, path=None):
             continue
 
         print(f"Processing prompt for conversation {cid}, current conversations count: {len(conversations)}", file=sys.stderr)
-        history = '\n'.join(conversations.get(cid, []))
-        print(f"Conversation {cid} has {len(conversations.get(cid, []))} previous messages", file=sys.stderr)
 
-        # Tell the UI we started
-        await ws.send(json.dumps({'type': 'status', 'status': 'running', 'conversationId': cid}))
+        # Output goes to every client following this conversation, not just this one
+        run = open_run_stream(cid, ws)
 
-        # Prepare the full prompt for the worker
-        full_prompt = f"{prompt}\n\n[conversation history]\n{history}"
+        async def report_queued(position, queue_length, _cid=cid):
+            try:
+                await run.send(json.dumps({'type': 'status', 'status': 'queued', 'conversationId': _cid,
+                                          'position': position, 'queueLength': queue_length}))
+            except Exception:
+                pass  # WS may be closed
 
-        async def run_gemini_task():
-            return await run_gemini(full_prompt, WORK_DIR, ws, cid)
+        async def run_gemini_task(_cid=cid, _work_dir=WORK_DIR, _prompt=prompt):
+            await run_scheduler.acquire(ws, _cid, report_queued)
+            try:
+                # History is read only now: an earlier run of this conversation may have
+                # been running while this one was queued, and its turn is saved by now
+                previous = await store_call(conversations.get, _cid) or []
+                history = history_window(_cid, previous)
+                print(f"Conversation {_cid} has {len(previous)} previous messages", file=sys.stderr)
+                full_prompt = f"{_prompt}\n\n[conversation history]\n{history}"
+
+                # Tell the UI we started
+                await run.send(json.dumps({'type': 'status', 'status': 'running', 'conversationId': _cid}))
+                rc, reply = await run_gemini(full_prompt, _work_dir, run, _cid, user_turn=_prompt)
+                if rc == 0:
+                    # Saved before the slot is released, so the next queued run sees this turn
+                    count = await store_call(conversations.append, _cid, [f"User: {_prompt}", f"Model: {reply}"])
+                    print(f"Saved conversation {_cid}, now has {count} messages", file=sys.stderr)
+                return rc, reply
+            finally:
+                run_scheduler.release(_cid)
 
         # START the task, but DO NOT AWAIT IT here (keep the WS loop responsive).
         task = asyncio.create_task(run_gemini_task())
-        active_tasks[cid] = task
+        active_tasks.setdefault(cid, []).append(task)
 
-        async def _finalize(t: asyncio.Task, _cid=cid, _prompt=prompt):
+        async def _finalize(t: asyncio.Task, _cid=cid, _run=run):
             rc, reply = -1, ""
             try:
                 rc, reply = await t
-                if rc == 0:
-                    conversations.setdefault(_cid, []).extend([f"User: {_prompt}", f"Model: {reply}"])
-                    save_conversations(conversations)
-                    print(f"Saved conversation {_cid}, now has {len(conversations.get(_cid, []))} messages", file=sys.stderr)
             except asyncio.CancelledError:
                 rc, reply = -1, "[Cancelled by user]"
                 try:
-                    await ws.send(json.dumps({'type': 'stream', 'stream': 'stderr', 'data': '\n[Cancelled by user]\n'}))
+                    await _run.send_stream('stderr', '\n[Cancelled by user]\n')
                 except Exception:
                     pass  # WS may be closed
             finally:
-                active_tasks.pop(_cid, None)
+                tasks = active_tasks.get(_cid)
+                if tasks and t in tasks:
+                    tasks.remove(t)
+                    if not tasks:
+                        del active_tasks[_cid]
                 try:
-                    await ws.send(json.dumps({'type': 'status', 'status': 'complete', 'conversationId': _cid}))
-                    await ws.send(json.dumps({'type': 'result', 'returncode': rc, 'conversationId': _cid}))
+                    await _run.send(json.dumps({'type': 'status', 'status': 'complete', 'conversationId': _cid}))
+                    await _run.send(json.dumps({'type': 'result', 'returncode': rc, 'conversationId': _cid}))
                 except Exception:
                     pass  # WS may be closed
+                finish_run_stream(_run)
 
         asyncio.create_task(_finalize(task))
         # Loop continues WITHOUT awaiting the task; we can now receive 'cancel' immediately.
@@ -1397,9 +4627,10 @@ async def cleanup_processes():
     print("Cleaning up processes...", file=sys.stderr)
     
     # Cancel all active tasks
-    for cid, task in list(active_tasks.items()):
+    for cid, tasks in list(active_tasks.items()):
         try:
-            task.cancel()
+            for task in tasks:
+                task.cancel()
             await asyncio.sleep(0.1)  # Give tasks a moment to cancel
         except Exception as e:
             print(f"Error cancelling task {cid}: {e}", file=sys.stderr)
@@ -1415,14 +4646,17 @@ async def cleanup_processes():
         except Exception as e:
             print(f"Error cleaning up process {cid}: {e}", file=sys.stderr)
     
-    # Kill all frontend processes
+    for _, task in list(active_searches.values()):
+        task.cancel()
+    
+    # Stop parked gemini workers and persistent sessions
+    await gemini_pool.drain()
+    await gemini_sessions.close_all()
+    
+    # Stop all preview servers and frontend processes
     for port, proc in list(frontend_processes.items()):
         try:
-            proc.terminate()
-            await asyncio.wait_for(proc.wait(), timeout=2.0)
-        except asyncio.TimeoutError:
-            proc.kill()
-            await proc.wait()
+            await _stop_frontend(proc)
         except Exception as e:
             print(f"Error cleaning up frontend process on port {port}: {e}", file=sys.stderr)
     
@@ -1444,11 +4678,14 @@ async def main():
     signal.signal(signal.SIGTERM, signal_handler)
     
     try:
+        static_assets.load()
         runner = web.AppRunner(app)
         await runner.setup()
         site = web.TCPSite(runner, HOST, PORT + 1)
         await site.start()
         ws_server = await websockets.serve(ws_handler, HOST, PORT)
+        gemini_pool.prime(WORK_DIR)
+        asyncio.create_task(reap_idle_previews())
         print(f"HTTP  at http://{HOST}:{PORT+1}  |  WS at ws://{HOST}:{PORT}")
         await ws_server.wait_closed()
     except KeyboardInterrupt:
@@ -0,0 +1,84 @@
+"""
+Benchmark for WebSocket file operations (get_file / save_file) and event loop lag.
+
+FILES files of SIZE MB are each read and rewritten concurrently while a ticker
+measures how late every 5 ms tick fires. The baseline does what the handlers did
+before they moved to the file I/O pool: read_text()/write_text() on the loop.
+
+    python bench_file_io.py [--files 4] [--size-mb 5] [--runs 3]
+"""
+
+import argparse
+import asyncio
+import os
+import pathlib
+import statistics
+import tempfile
+import time
+
+# backend creates its work dirs at import time; keep them out of $HOME
+_TMP = tempfile.mkdtemp(prefix='gemmit-bench-')
+os.environ.setdefault('GENERATIONS_DIR', _TMP)
+os.environ.setdefault('OUTPUT_DIR', _TMP)
+
+import backend  # noqa: E402
+
+TICK = 0.005
+
+
+async def on_loop(path: pathlib.Path):
+    content = path.read_text()
+    path.write_text(content)
+
+
+async def on_pool(path: pathlib.Path):
+    content = await backend.file_call(backend._read_file_sync, path)
+    await backend.file_call(backend._atomic_write_sync, path, content)
+
+
+async def ticker(lags: list, stop: asyncio.Event):
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        due = loop.time() + TICK
+        await asyncio.sleep(TICK)
+        lags.append((loop.time() - due) * 1000)
+
+
+async def run(op, paths):
+    lags, stop = [], asyncio.Event()
+    tick = asyncio.create_task(ticker(lags, stop))
+    await asyncio.sleep(TICK * 4)  # let the ticker settle
+    lags.clear()
+    started = time.perf_counter()
+    await asyncio.gather(*(op(p) for p in paths))
+    elapsed = time.perf_counter() - started
+    stop.set()
+    await tick
+    return elapsed, lags
+
+
+async def main(files: int, size_mb: int, runs: int):
+    work = pathlib.Path(tempfile.mkdtemp(prefix='gemmit-bench-files-'))
+    line = 'the quick brown fox jumps over the lazy dog, ünïcödé included\n'
+    body = line * (size_mb * 1024 * 1024 // len(line.encode('utf-8')))
+    paths = []
+    for i in range(files):
+        path = work / f'file{i}.txt'
+        path.write_text(body, encoding='utf-8')
+        paths.append(path)
+    backend.MAX_FILE_READ_BYTES = backend.MAX_FILE_WRITE_BYTES = max(backend.MAX_FILE_WRITE_BYTES, 2 * len(body.encode('utf-8')))
+
+    for label, op in (('on the loop (before)', on_loop), ('file I/O pool', on_pool)):
+        for n in range(runs):
+            elapsed, lags = await run(op, paths)
+            print(f"{label:21} run {n + 1}: {elapsed * 1000:6.0f} ms total, tick lag "
+                  f"p50 {statistics.median(lags):5.1f} ms, max {max(lags):5.1f} ms over {len(lags)} ticks")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--files', type=int, default=4)
+    parser.add_argument('--size-mb', type=int, default=5)
+    parser.add_argument('--runs', type=int, default=3)
+    args = parser.parse_args()
+    asyncio.run(main(args.files, args.size_mb, args.runs))
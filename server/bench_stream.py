@@ -0,0 +1,80 @@
+"""
+Benchmark for stream_pipe (gemini stdout -> WebSocket stream frames).
+
+A child process writes LINES lines of about 60 bytes as fast as it can; a sink
+that only serializes frames stands in for the WebSocket. The per-line reader
+stream_pipe used before output was batched runs as the baseline. A second
+child prints a line every 200 ms to show that batching does not hold output back.
+
+    python bench_stream.py [--lines 200000]
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import sys
+import tempfile
+import time
+
+# backend creates its work dirs at import time; keep them out of $HOME
+_TMP = tempfile.mkdtemp(prefix='gemmit-bench-')
+os.environ.setdefault('GENERATIONS_DIR', _TMP)
+os.environ.setdefault('OUTPUT_DIR', _TMP)
+
+import backend  # noqa: E402
+
+FLOOD = "import sys\nline = 'x' * 59 + '\\n'\nw = sys.stdout.write\nfor _ in range({lines}): w(line)\n"
+TRICKLE = "import sys, time\nfor i in range(10):\n    print(time.monotonic(), flush=True)\n    time.sleep(0.2)\n"
+
+
+class _Sink:
+    def __init__(self):
+        self.frames = 0
+        self.arrivals = []  # (time received, data)
+
+    async def send_stream(self, stream, data, **fields):
+        json.dumps({'type': 'stream', 'stream': stream, 'data': data, **fields})
+        self.frames += 1
+        self.arrivals.append((time.monotonic(), data))
+
+    async def send(self, message):
+        self.frames += 1
+        self.arrivals.append((time.monotonic(), json.loads(message)['data']))
+
+
+async def per_line_pipe(pipe, name, ws, buffer):
+    """stream_pipe before batching: one frame per line."""
+    while True:
+        chunk = await pipe.readline()
+        if not chunk:
+            break
+        data = chunk.decode()
+        if name == 'stdout':
+            buffer.append(data)
+        await ws.send(json.dumps({'type': 'stream', 'stream': name, 'data': data}))
+
+
+async def run(pipe_fn, script):
+    sink = _Sink()
+    proc = await asyncio.create_subprocess_exec(sys.executable, '-c', script, stdout=asyncio.subprocess.PIPE)
+    wall, cpu = time.perf_counter(), time.process_time()
+    await pipe_fn(proc.stdout, 'stdout', sink, [])
+    await proc.wait()
+    return sink, time.perf_counter() - wall, time.process_time() - cpu
+
+
+async def main(lines: int):
+    for label, pipe_fn in (('per-line (before)', per_line_pipe), ('batched (stream_pipe)', backend.stream_pipe)):
+        sink, wall, cpu = await run(pipe_fn, FLOOD.format(lines=lines))
+        print(f"{label:22} {lines} lines: {sink.frames:7} frames, {wall:.2f} s wall, {cpu:.2f} s CPU (this process)")
+        sink, _, _ = await run(pipe_fn, TRICKLE)
+        delays = [(received - float(line)) * 1000
+                  for received, data in sink.arrivals for line in data.split()]
+        print(f"{'':22} trickle: max {max(delays):.1f} ms from print to frame")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--lines', type=int, default=200_000)
+    asyncio.run(main(parser.parse_args().lines))
@@ -0,0 +1,10 @@
+import os
+import pathlib
+import sys
+import tempfile
+
+# backend creates its work dirs at import time; keep them out of $HOME
+_TMP = tempfile.mkdtemp(prefix='gemmit-test-')
+os.environ.setdefault('GENERATIONS_DIR', _TMP)
+os.environ.setdefault('OUTPUT_DIR', _TMP)
+sys.path.insert(0, str(pathlib.Path(__file__).resolve().parent))
@@ -0,0 +1,102 @@
+"""
+Conversation storage on disk: migration from the legacy single-file store to
+per-conversation shards, recovery from torn (crash mid-append) log tails, and
+the SQLite store's import of the file store.
+"""
+
+import json
+import sqlite3
+
+import pytest
+
+from backend import ConversationStore, SQLiteConversationStore, _read_log_records
+
+
+def _write_lines(path, records, tail=''):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    path.write_text(''.join(json.dumps(r) + '\n' for r in records) + tail, encoding='utf-8')
+
+
+@pytest.fixture
+def legacy_workspace(tmp_path):
+    config = tmp_path / '.gemmit'
+    config.mkdir()
+    (config / 'conversations.json').write_text(json.dumps({
+        'a': ['User: hello', 'Model: hi'],
+        'empty': [],
+    }), encoding='utf-8')
+    _write_lines(config / 'conversations.log', [
+        {'id': 'a', 'at': 2, 'turns': ['User: more', 'Model: sure']},
+        {'id': 'a', 'at': 2, 'turns': ['User: more', 'Model: sure']},  # replayed twice
+        {'id': 'b', 'at': 0, 'turns': ['User: only in the log', 'Model: ok']},
+        {'id': 'b', 'at': 5, 'turns': ['User: after a gap']},
+    ], tail='{"id": "b", "at": 2, "turns": ["User: torn')
+    return tmp_path
+
+
+def test_legacy_store_is_migrated_to_shards(legacy_workspace):
+    store = ConversationStore(legacy_workspace)
+
+    assert store.get('a') == ['User: hello', 'Model: hi', 'User: more', 'Model: sure']
+    assert store.get('b') == ['User: only in the log', 'Model: ok']
+    assert 'empty' not in store
+    assert store.index['a']['messageCount'] == 4
+    assert store.index['b']['preview'] == 'only in the log'
+
+    config = legacy_workspace / '.gemmit'
+    assert not (config / 'conversations.json').exists()
+    assert (config / 'conversations.json.migrated').exists()
+    assert (config / 'conversations.log.migrated').exists()
+    assert (config / 'conversations' / 'a.jsonl').exists()
+
+
+def test_migration_runs_once(legacy_workspace):
+    ConversationStore(legacy_workspace).append('a', ['User: new', 'Model: turn'])
+    reopened = ConversationStore(legacy_workspace)
+    assert reopened.get('a')[-2:] == ['User: new', 'Model: turn']
+    assert len(reopened.get('a')) == 6
+
+
+def test_torn_log_tail_is_dropped_and_truncated(tmp_path):
+    log = tmp_path / 'x.log'
+    _write_lines(log, [{'n': 1}, {'n': 2}], tail='{"n": 3')
+    assert _read_log_records(log) == [{'n': 1}, {'n': 2}]
+    assert log.read_text(encoding='utf-8').endswith('{"n": 2}\n')
+
+
+def test_bad_record_in_the_middle_is_skipped(tmp_path):
+    log = tmp_path / 'x.log'
+    log.write_text('{"n": 1}\nnot json\n{"n": 3}\n', encoding='utf-8')
+    assert _read_log_records(log) == [{'n': 1}, {'n': 3}]
+
+
+def test_torn_shard_and_index_tails_recover(tmp_path):
+    store = ConversationStore(tmp_path)
+    store.append('c', ['User: one', 'Model: two'])
+    store.append('c', ['User: three', 'Model: four'])
+    root = tmp_path / '.gemmit' / 'conversations'
+    with open(root / 'c.jsonl', 'a', encoding='utf-8') as f:
+        f.write('{"id": "c", "at": 4, "turns": ["User: lost')
+    with open(root / 'index.log', 'a', encoding='utf-8') as f:
+        f.write('{"id": "c", "messageCount": 9')
+
+    reopened = ConversationStore(tmp_path)
+    assert reopened.index['c']['messageCount'] == 4
+    assert reopened.get('c') == ['User: one', 'Model: two', 'User: three', 'Model: four']
+    # The next append starts on a clean line and survives another reopen
+    assert reopened.append('c', ['User: five', 'Model: six']) == 6
+    assert ConversationStore(tmp_path).get('c')[-1] == 'Model: six'
+
+
+def test_sqlite_store_imports_the_file_store(legacy_workspace):
+    try:
+        store = SQLiteConversationStore(legacy_workspace)
+    except sqlite3.Error as e:
+        pytest.skip(f'SQLite unavailable: {e}')
+    try:
+        assert len(store) == 2
+        assert store.get('a') == ['User: hello', 'Model: hi', 'User: more', 'Model: sure']
+        assert store.get('b') == ['User: only in the log', 'Model: ok']
+        assert store.append('b', ['User: next', 'Model: done']) == 4
+    finally:
+        store.close()
@@ -0,0 +1,102 @@
+"""
+IgnoreMatcher against gitignore semantics: anchoring, directory-only rules,
+negation and last-match-wins across the merged rule groups.
+"""
+
+import pytest
+
+from backend import IgnoreMatcher, parse_ignore_line
+
+
+def _ignored(lines, path, is_dir=False):
+    return IgnoreMatcher(lines).ignored_path(path, is_dir)
+
+
+@pytest.mark.parametrize('line', ['', '   ', '# comment', '!', '/'])
+def test_blank_and_comment_lines_are_skipped(line):
+    assert parse_ignore_line(line) is None
+
+
+def test_trailing_comment_is_stripped():
+    assert parse_ignore_line('node_modules/   # deps') == ('name', 'node_modules', False, True)
+
+
+@pytest.mark.parametrize('path, expected', [
+    ('debug.log', True),
+    ('src/deep/debug.log', True),
+    ('debug.log.txt', False),
+])
+def test_unanchored_name_matches_at_any_depth(path, expected):
+    assert _ignored(['*.log'], path) is expected
+
+
+@pytest.mark.parametrize('path, expected', [
+    ('build', True),
+    ('build/out.js', True),
+    ('src/build', False),
+    ('src/build/out.js', False),
+])
+def test_leading_slash_anchors_to_root(path, expected):
+    assert _ignored(['/build'], path) is expected
+
+
+@pytest.mark.parametrize('path, expected', [
+    ('docs/a.md', True),
+    ('src/docs/a.md', False),  # a slash in the middle anchors too
+    ('docs/sub/a.md', False),  # '*' does not cross '/'
+])
+def test_middle_slash_anchors_to_root(path, expected):
+    assert _ignored(['docs/*.md'], path) is expected
+
+
+@pytest.mark.parametrize('pattern', ['**/cache', 'cache'])
+def test_double_star_prefix_is_unanchored(pattern):
+    assert _ignored([pattern], 'a/b/cache', is_dir=True)
+    assert _ignored([pattern], 'cache/x.bin')
+
+
+def test_double_star_in_the_middle():
+    assert _ignored(['a/**/z.txt'], 'a/z.txt')
+    assert _ignored(['a/**/z.txt'], 'a/b/c/z.txt')
+    assert not _ignored(['a/**/z.txt'], 'x/a/b/z.txt')
+
+
+def test_dir_only_rule_skips_files():
+    assert _ignored(['logs/'], 'logs', is_dir=True)
+    assert _ignored(['logs/'], 'logs/today.txt')
+    assert not _ignored(['logs/'], 'logs')  # a file called logs
+
+
+def test_negation_re_includes():
+    lines = ['*.log', '!keep.log']
+    assert _ignored(lines, 'a.log')
+    assert not _ignored(lines, 'keep.log')
+    assert not _ignored(lines, 'sub/keep.log')
+
+
+def test_last_matching_rule_wins():
+    assert _ignored(['!keep.log', '*.log'], 'keep.log')
+    assert not _ignored(['*.log', '!keep.log', 'other.txt'], 'keep.log')
+    assert _ignored(['*.log', '!keep.log', 'keep.log'], 'keep.log')
+
+
+def test_negation_inside_an_ignored_directory_does_not_re_include():
+    # As in git: a file can't be re-included once its parent directory is excluded
+    assert _ignored(['dist/', '!dist/keep.js'], 'dist/keep.js')
+
+
+def test_escaped_hash_and_bang():
+    assert _ignored(['\\#notes'], '#notes')
+    assert _ignored(['\\!important'], '!important')
+
+
+def test_character_classes():
+    lines = ['file[0-9].txt', 'tmp[!a].dat']
+    assert _ignored(lines, 'file7.txt')
+    assert not _ignored(lines, 'filex.txt')
+    assert _ignored(lines, 'tmpb.dat')
+    assert not _ignored(lines, 'tmpa.dat')
+
+
+def test_no_rules_ignore_nothing():
+    assert not _ignored([], 'anything/at/all.txt')
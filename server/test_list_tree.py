@@ -0,0 +1,45 @@
+"""
+_list_tree_sync pagination: cursors resume the walk where the last page ended,
+and a page that runs out of time never reads as the end of the listing.
+"""
+
+import backend
+from backend import _list_tree_sync
+
+
+def _make_tree(root):
+    for rel in ['a/x.txt', 'a/y.txt', 'b/z.txt', 'c.txt']:
+        path = root / rel
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(rel)
+
+
+def _walk_all(root, limit):
+    paths, cursor = [], None
+    while True:
+        page = _list_tree_sync(root, '', cursor, limit)
+        paths += [e['path'] for e in page['entries']]
+        cursor = page['nextCursor']
+        if cursor is None:
+            return paths
+
+
+def test_pages_cover_the_tree_in_order(tmp_path):
+    _make_tree(tmp_path)
+    expected = ['a', 'a/x.txt', 'a/y.txt', 'b', 'b/z.txt', 'c.txt']
+    assert _walk_all(tmp_path, 1000) == expected
+    assert _walk_all(tmp_path, 2) == expected
+
+
+def test_timed_out_page_returns_its_start_cursor(tmp_path, monkeypatch):
+    _make_tree(tmp_path)
+    monkeypatch.setattr(backend, 'TREE_WALK_BUDGET', -1)
+
+    first = _list_tree_sync(tmp_path)
+    assert first == {'entries': [], 'nextCursor': '', 'timedOut': True}
+
+    later = _list_tree_sync(tmp_path, '', 'a/x.txt')
+    assert later == {'entries': [], 'nextCursor': 'a/x.txt', 'timedOut': True}
+
+    monkeypatch.undo()
+    assert [e['path'] for e in _list_tree_sync(tmp_path, '', first['nextCursor'])['entries']][0] == 'a'
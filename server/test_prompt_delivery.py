@@ -0,0 +1,76 @@
+"""
+Prompt delivery to gemini (GEMINI_PROMPT_MODE), checked against a shell stub
+that reports its argv and echoes whatever arrives on stdin.
+"""
+
+import asyncio
+import os
+
+import pytest
+
+import backend
+
+pytestmark = pytest.mark.skipif(os.name != 'posix', reason='stub gemini is a shell script')
+
+STUB = """#!/bin/sh
+printf 'ARGV=%s\\n' "$*"
+printf 'STDIN='
+cat
+"""
+
+# Well past Linux's 128 KiB limit on a single argv string (MAX_ARG_STRLEN)
+LARGE_PROMPT = 'x' * (1024 * 1024) + '\nend of prompt'
+
+
+class _Sink:
+    def __init__(self):
+        self.frames = []
+
+    async def send_stream(self, stream, data):
+        self.frames.append((stream, data))
+
+    async def send(self, message):
+        pass
+
+
+@pytest.fixture
+def stub_gemini(tmp_path, monkeypatch):
+    stub = tmp_path / 'gemini'
+    stub.write_text(STUB)
+    stub.chmod(0o755)
+    monkeypatch.setattr(backend, 'GEMINI_BIN', str(stub))
+    return tmp_path
+
+
+def _run(mode, prompt, work_dir, monkeypatch):
+    monkeypatch.setattr(backend, 'GEMINI_PROMPT_MODE', mode)
+    sink = _Sink()
+    rc, reply = asyncio.run(backend.run_gemini(prompt, work_dir, sink, 'test'))
+    return rc, reply
+
+
+@pytest.mark.parametrize('mode', ['stdin', 'file'])
+def test_prompt_is_not_on_the_command_line(mode, stub_gemini, monkeypatch):
+    rc, reply = _run(mode, 'hello\nworld', stub_gemini, monkeypatch)
+    assert rc == 0
+    assert 'hello' not in reply.split('STDIN=')[0]
+    assert reply.endswith('STDIN=hello\nworld')
+
+
+def test_argv_mode_passes_prompt_as_p_flag(stub_gemini, monkeypatch):
+    rc, reply = _run('argv', 'hello world', stub_gemini, monkeypatch)
+    assert rc == 0
+    assert f'ARGV=-y -a -p hello world -m {backend.GEMINI_MODEL}\n' in reply
+    assert reply.endswith('STDIN=')
+
+
+@pytest.mark.parametrize('mode', ['stdin', 'file'])
+def test_prompt_too_large_for_argv(mode, stub_gemini, monkeypatch):
+    rc, reply = _run(mode, LARGE_PROMPT, stub_gemini, monkeypatch)
+    assert rc == 0
+    assert reply.split('STDIN=', 1)[1] == LARGE_PROMPT
+
+
+def test_argv_mode_cannot_carry_a_large_prompt(stub_gemini, monkeypatch):
+    with pytest.raises(OSError):
+        _run('argv', LARGE_PROMPT, stub_gemini, monkeypatch)
@@ -0,0 +1,98 @@
+"""
+RunScheduler: per-client round-robin, one run per conversation, and queued
+runs that are cancelled before or while they are dispatched.
+"""
+
+import asyncio
+
+from backend import RunScheduler
+
+
+async def _no_position(position, queue_length):
+    pass
+
+
+async def _acquire(scheduler, client, conversation_id, started):
+    await scheduler.acquire(client, conversation_id, _no_position)
+    started.append(conversation_id)
+
+
+def _within(awaitable):
+    return asyncio.wait_for(awaitable, 1)
+
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+def test_clients_take_turns():
+    async def scenario():
+        scheduler, started = RunScheduler(1), []
+        await scheduler.acquire('x', 'hold', _no_position)
+        tasks = [asyncio.create_task(_acquire(scheduler, client, cid, started))
+                 for client, cid in [('a', 'a1'), ('a', 'a2'), ('a', 'a3'), ('b', 'b1')]]
+        await _settle()
+        for previous in ['hold', 'a1', 'b1', 'a2']:
+            scheduler.release(previous)
+            await _settle()
+        await _within(asyncio.gather(*tasks))
+        return started
+
+    # b1 was queued last but does not wait behind all of client a's runs
+    assert asyncio.run(scenario()) == ['a1', 'b1', 'a2', 'a3']
+
+
+def test_one_run_per_conversation():
+    async def scenario():
+        scheduler, started = RunScheduler(2), []
+        first = asyncio.create_task(_acquire(scheduler, 'a', 'c', started))
+        second = asyncio.create_task(_acquire(scheduler, 'b', 'c', started))
+        other = asyncio.create_task(_acquire(scheduler, 'b', 'd', started))
+        await _settle()
+        before_release = list(started)
+        scheduler.release('c')
+        await _within(asyncio.gather(first, second, other))
+        return before_release, started
+
+    before_release, started = asyncio.run(scenario())
+    assert before_release == ['c', 'd']  # the second 'c' run is skipped over, not blocking 'd'
+    assert started == ['c', 'd', 'c']
+
+
+def test_cancelled_queued_run_is_skipped():
+    async def scenario():
+        scheduler, started = RunScheduler(1), []
+        await scheduler.acquire('x', 'hold', _no_position)
+        doomed = asyncio.create_task(_acquire(scheduler, 'a', 'doomed', started))
+        kept = asyncio.create_task(_acquire(scheduler, 'a', 'kept', started))
+        await _settle()
+        doomed.cancel()
+        # Released in the same tick, before the cancelled waiter has cleaned up its ticket
+        scheduler.release('hold')
+        await _settle()
+        await _within(kept)
+        return started, doomed.cancelled(), scheduler.stats()
+
+    started, cancelled, stats = asyncio.run(scenario())
+    assert cancelled
+    assert started == ['kept']
+    assert stats['running'] == ['kept'] and stats['queued'] == []
+
+
+def test_run_cancelled_after_dispatch_releases_its_slot():
+    async def scenario():
+        scheduler, started = RunScheduler(1), []
+        await scheduler.acquire('x', 'hold', _no_position)
+        doomed = asyncio.create_task(_acquire(scheduler, 'a', 'doomed', started))
+        kept = asyncio.create_task(_acquire(scheduler, 'b', 'kept', started))
+        await _settle()
+        scheduler.release('hold')  # hands the slot to 'doomed'
+        doomed.cancel()            # before it got to run
+        await _settle()
+        await _within(kept)
+        return started, scheduler.stats()
+
+    started, stats = asyncio.run(scenario())
+    assert started == ['kept']
+    assert stats['running'] == ['kept']
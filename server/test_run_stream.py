@@ -0,0 +1,77 @@
+"""
+Run streams shared by runs queued on one conversation, driven over a real
+WebSocket against a stub gemini that prints, sleeps and prints again.
+"""
+
+import asyncio
+import json
+import os
+
+import pytest
+import websockets
+
+import backend
+
+pytestmark = pytest.mark.skipif(os.name != 'posix', reason='stub gemini is a shell script')
+
+STUB = """#!/bin/sh
+cat >/dev/null
+echo begin
+sleep 0.4
+echo end
+"""
+
+
+@pytest.fixture
+def stub_gemini(tmp_path, monkeypatch):
+    stub = tmp_path / 'gemini'
+    stub.write_text(STUB)
+    stub.chmod(0o755)
+    monkeypatch.setattr(backend, 'GEMINI_BIN', str(stub))
+    monkeypatch.setattr(backend, 'GEMINI_PROMPT_MODE', 'stdin')
+    monkeypatch.setattr(backend, 'WORK_DIR', tmp_path)
+
+
+async def _collect(ws, conversation_id, results):
+    """Frames for conversation_id until `results` result frames have arrived."""
+    frames = []
+    while sum(f.get('type') == 'result' for f in frames) < results:
+        frame = json.loads(await asyncio.wait_for(ws.recv(), 10))
+        if frame.get('conversationId') == conversation_id:
+            frames.append(frame)
+    return frames
+
+
+def _stdout(frames):
+    return ''.join(f['data'] for f in frames if f.get('stream') == 'stdout')
+
+
+def test_queued_runs_share_one_stream_and_resubscribe_mid_run(stub_gemini):
+    async def scenario():
+        server = await websockets.serve(backend.ws_handler, '127.0.0.1', 0)
+        url = f"ws://127.0.0.1:{server.sockets[0].getsockname()[1]}"
+        try:
+            async with websockets.connect(url, max_size=None) as origin:
+                await origin.send(json.dumps({'prompt': 'a', 'conversationId': 'c'}))
+                await origin.send(json.dumps({'prompt': 'b', 'conversationId': 'c'}))
+                origin_frames = asyncio.create_task(_collect(origin, 'c', 2))
+                await asyncio.sleep(0.2)  # run a has printed "begin", run b is queued
+
+                async with websockets.connect(url, max_size=None) as late:
+                    await late.send(json.dumps({'command': 'subscribe', 'conversationId': 'c', 'fromSeq': 0}))
+                    subscribed = json.loads(await asyncio.wait_for(late.recv(), 10))
+                    late_frames = await _collect(late, 'c', 2)
+                return subscribed, late_frames, await origin_frames
+        finally:
+            server.close()
+            await server.wait_closed()
+
+    subscribed, late_frames, origin_frames = asyncio.run(scenario())
+
+    assert subscribed['type'] == 'subscribed' and subscribed['running']
+    assert subscribed['nextSeq'] > 0  # run a's frames, not a fresh stream for run b
+    for frames in (origin_frames, late_frames):
+        seqs = [f['seq'] for f in frames]
+        assert seqs == sorted(set(seqs))
+        assert _stdout(frames).split() == ['begin', 'end', 'begin', 'end']
+        assert [f['returncode'] for f in frames if f.get('type') == 'result'] == [0, 0]